@@ -1,8 +1,43 @@
 import os
 import re
 import subprocess     # FFmpegを直接実行するためにインポート
+from collections import deque
+
+try:
+    import av  # PyAV: プロセスを起動せずにコンテナ情報を読むために使用
+except ImportError:
+    av = None
+
+# FFmpegの統計表示 (stderr) から経過時間を取り出す正規表現。バイト列のまま照合する。
+# 通常は -progress の出力を使い、これはフォールバックとしてのみ使う。
+_TIME_RE = re.compile(rb"time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})")
+# -progress が出力する "key=value" 形式の行。エラーメッセージの保持対象から除外するために使う。
+_PROGRESS_LINE_RE = re.compile(rb"^\w+=\S*$")
+# close_fds=Falseにするのはposix_spawnが使えるPOSIXだけ。Windowsで無効にすると継承するハンドルが
+# 制限されなくなり、同時に起動した子プロセス同士がパイプのハンドルを継承してしまう。
+_CLOSE_FDS = os.name != 'posix'
+
+class FFmpegError(Exception):
+    """
+    FFmpegが0以外の終了コードで終了したときに送出する例外。
+    メッセージは短くし、FFmpegの出力の末尾 (パスやビルド設定を含む) はstderr_tailに分けて保持する。
+    """
+    def __init__(self, returncode, stderr_tail):
+        super().__init__(f"FFmpeg failed (exit code {returncode})")
+        self.returncode = returncode
+        self.stderr_tail = stderr_tail
 
 def get_video_duration(ffprobe_path, video_path):
+    """動画の長さを秒単位で取得する。PyAVが使えればプロセス内で、使えなければffprobeで取得する。"""
+    if av is not None:
+        try:
+            with av.open(video_path) as container:
+                return float(container.duration) / av.time_base if container.duration else None
+        except (av.error.FFmpegError, OSError) as e:
+            print(f"PyAVでの動画情報の取得に失敗したため、ffprobeにフォールバックします: {e}")
+    return _get_video_duration_with_ffprobe(ffprobe_path, video_path)
+
+def _get_video_duration_with_ffprobe(ffprobe_path, video_path):
     """ffprobeを使って動画の長さを秒単位で取得する"""
     cmd = [
         ffprobe_path,
@@ -12,10 +47,13 @@ def get_video_duration(ffprobe_path, video_path):
         video_path
     ]
     try:
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, text=True)
+        # 出力は数値のみなので、デコードせずバイト列のままfloatに変換する
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, close_fds=_CLOSE_FDS)
         return float(result.stdout)
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+    except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         print(f"ffprobeの実行に失敗しました: {e}")
+        if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+            print(f"ffprobe stderr: {e.stderr.decode('utf-8', 'replace')}")
         # フォールバックとしてNoneを返す
         return None
 
@@ -29,64 +67,99 @@ def run_conversion(
     width,
     conversion_duration,
     high_quality,
-    progress_callback=None
+    progress_callback=None,
+    threads=None,
+    time_limit=None,
+    fast_seek=True
 ):
     """
     フレームワークに依存しない汎用的なGIF変換関数。
     進捗を通知するためのコールバックを受け取ることができる。
+    threadsを指定すると、FFmpegのデコード・フィルター・エンコードのスレッド数をその値にする。
+    time_limitを指定すると、FFmpegはその秒数のCPU時間を使い切った時点で終了する (暴走したジョブの打ち切り用)。
+    fast_seekがTrueなら -ss を -i の前に置き、開始位置の手前のキーフレームへシークする。
+    (再エンコードする場合は -accurate_seek が既定で有効なため、切り出し位置はフレーム単位で正確になる)
+    Falseなら -ss を -i の後に置き、先頭からデコードして開始位置までのフレームを捨てる。
+    入力ファイルは削除しない。後片付けは呼び出し元が行う。
     """
-    palette_path = None
-    try:
-        base_cmd = [ffmpeg_path, '-ss', str(start_time)]
-        if end_time is not None:
-            duration = float(end_time) - float(start_time)
-            base_cmd.extend(['-t', str(duration)])
-        base_cmd.extend(['-i', input_path])
+    # 進捗はstderrへの構造化出力 (-progress) で受け取り、人間向けの統計表示は止める
+    base_cmd = [ffmpeg_path]
+    if time_limit:
+        base_cmd.extend(['-timelimit', str(int(time_limit))])
+    if threads:
+        # fps/scale(lanczos)/paletteuseはフィルタースレッドで並列化できるため、デコード・フィルターにも同じ数を割り当てる
+        base_cmd.extend(['-filter_threads', str(threads), '-filter_complex_threads', str(threads), '-threads', str(threads)])
+    base_cmd.extend(['-nostats', '-progress', 'pipe:2'])
+    seek_args = ['-ss', str(start_time)]
+    if end_time is not None:
+        duration = float(end_time) - float(start_time)
+        seek_args.extend(['-t', str(duration)])
+    if fast_seek:
+        base_cmd.extend(seek_args + ['-i', input_path])
+    else:
+        # 出力オプションとして指定する場合は、-t も -ss と同じく -i の後に置く
+        base_cmd.extend(['-i', input_path] + seek_args)
 
-        final_process = None
+    vf_options = f"fps={fps},scale={width}:-1:flags=lanczos"
+    if high_quality:
+        # パレット生成と適用を1回のFFmpeg実行で行う（デコードは1回、パレットPNGの書き出しも不要）
+        vf_options += ",split[a][b];[a]palettegen[p];[b][p]paletteuse"
 
-        if high_quality:
-            if progress_callback: progress_callback(0, 'Generating Palette')
-            palette_path = os.path.join(os.path.dirname(output_path), f"palette_{os.path.basename(input_path)}.png")
-            palette_vf = f"fps={fps},scale={width}:-1:flags=lanczos,palettegen"
-            palette_cmd = base_cmd + ['-vf', palette_vf, '-y', palette_path]
-            
-            palette_process = subprocess.run(palette_cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
-            if palette_process.returncode != 0:
-                raise Exception(f"Palette generation failed: {palette_process.stderr}")
+    if progress_callback: progress_callback(0, 'Creating GIF')
+    cmd = base_cmd + ['-vf', vf_options]
+    if threads:
+        cmd.extend(['-threads', str(threads)])
+    cmd.extend(['-y', output_path])
+    # POSIXではclose_fds=Falseかつ実行ファイルが絶対パスなら、CPythonはfork+execではなくposix_spawnを使う。
+    # (Pythonが開くFDは既定で継承不可なので、子プロセスに余計なFDは渡らない)
+    final_process = subprocess.Popen(cmd, stderr=subprocess.PIPE, bufsize=0, close_fds=_CLOSE_FDS)
 
-            if progress_callback: progress_callback(20, 'Creating GIF')
-            gif_vf = f"fps={fps},scale={width}:-1:flags=lanczos [x]; [x][1:v] paletteuse"
-            gif_cmd = base_cmd + ['-i', palette_path, '-lavfi', gif_vf, '-y', output_path]
-            final_process = subprocess.Popen(gif_cmd, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='replace')
-        else:
-            if progress_callback: progress_callback(0, 'Creating GIF')
-            vf_options = f"fps={fps},scale={width}:-1:flags=lanczos"
-            cmd = base_cmd + ['-vf', vf_options, '-y', output_path]
-            final_process = subprocess.Popen(cmd, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='replace')
+    # -progress pipe:2 により、FFmpegはstderrに "out_time_us=1234567" のような
+    # key=value 形式の行を出力する。生のFDから届いた分だけ読み取り、行単位で解析する。
+    stderr_fd = final_process.stderr.fileno()
+    buf = b""
+    last_progress = 0
+    # 失敗時のエラーメッセージ用に、進捗以外の出力の末尾を保持しておく
+    # (ループでパイプを読み切るため、終了後にstderrを読み直しても何も得られない)
+    stderr_tail = deque(maxlen=40)
 
-        time_pattern = re.compile(r"time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})")
-        
-        for line in iter(final_process.stderr.readline, ''):
-            match = time_pattern.search(line)
-            if match:
-                hours, minutes, seconds, hundredths = map(int, match.groups())
-                current_time = hours * 3600 + minutes * 60 + seconds + hundredths / 100
+    while True:
+        chunk = os.read(stderr_fd, 4096)
+        if not chunk:
+            break
+        buf += chunk
+        *lines, buf = buf.split(b'\n')
+        # 改行が来ないまま溜まり続けないよう、未完成の行は上限を設けておく
+        buf = buf[-4096:]
 
-                if conversion_duration > 0:
-                    base_progress = 20 if high_quality else 0
-                    progress_percentage = (current_time / conversion_duration) * (100 - base_progress)
-                    progress = min(100, int(base_progress + progress_percentage))
-                    if progress_callback: progress_callback(progress, 'Creating GIF')
+        current_time = None
+        for line in lines:
+            if line.startswith(b'out_time_us='):
+                value = line[12:].strip()
+                if value.isdigit():
+                    current_time = int(value) / 1_000_000
+            elif line.strip() and not _PROGRESS_LINE_RE.match(line.strip()):
+                stderr_tail.append(line)
+        if current_time is None:
+            # 構造化された進捗が得られない場合は、従来の "time=HH:MM:SS.cc" 表示にフォールバックする
+            matches = _TIME_RE.findall(b'\n'.join(lines) + buf)
+            if matches:
+                hours, minutes, seconds, hundredths = matches[-1]
+                current_time = int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(hundredths) / 100
 
-        final_process.wait()
+        if current_time is not None and conversion_duration > 0:
+            progress = min(100, int((current_time / conversion_duration) * 100))
+            # 同じ進捗率での重複通知は省く
+            if progress != last_progress:
+                last_progress = progress
+                if progress_callback: progress_callback(progress, 'Creating GIF')
 
-        if final_process.returncode != 0:
-            raise Exception(f"FFmpeg failed: {final_process.stderr.read()}")
+    final_process.wait()
 
-        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-            raise Exception("Output GIF file was not created.")
+    if final_process.returncode != 0:
+        if buf.strip():
+            stderr_tail.append(buf)
+        raise FFmpegError(final_process.returncode, b"\n".join(stderr_tail).decode('utf-8', 'replace'))
 
-    finally:
-        if os.path.exists(input_path): os.remove(input_path)
-        if palette_path and os.path.exists(palette_path): os.remove(palette_path)
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        raise Exception("Output GIF file was not created.")
@@ -5,11 +5,26 @@ import sys
 import subprocess
 import logging
 import threading
+import time
+import queue
+import hashlib
+import atexit
+from concurrent.futures import Future, ThreadPoolExecutor
 from flask import Flask, request, jsonify, url_for, Response, render_template, stream_with_context, send_file
-from dataclasses import dataclass
+from flask.json.provider import DefaultJSONProvider
+from dataclasses import dataclass, asdict
 from pathlib import Path
 from datetime import datetime
 
+try:
+    import av  # PyAV: ffprobeを起動せずに動画の長さを取得するために使用
+except ImportError:
+    av = None
+try:
+    import orjson  # 高速なJSONライブラリ (なければFlask標準のJSONプロバイダーを使う)
+except ImportError:
+    orjson = None
+
 def get_resource_path(relative_path):
     """
     リソースへの絶対パスを取得します。開発環境とPyInstallerバンドルの両方で機能します。
@@ -41,6 +56,23 @@ log = logging.getLogger('werkzeug')
 log.disabled = True
 app.config['IS_DESKTOP_APP'] = False # デフォルトはWebアプリモード
 
+class ORJSONProvider(DefaultJSONProvider):
+    """jsonifyやrequest.get_jsonのJSON処理をorjsonで行うプロバイダー。"""
+    def dumps(self, obj, **kwargs):
+        # orjsonの出力は常に区切り文字の空白を含まないため、separatorsの指定は不要
+        kwargs.pop('separators', None)
+        if kwargs:
+            # indentなど標準jsonのオプションが指定された場合は既定の実装に任せる
+            return super().dumps(obj, **kwargs)
+        # 既定の実装と同じくキーを並べ替え、ETagなどが実装によって変わらないようにする
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+if orjson:
+    app.json = ORJSONProvider(app)
+
 # --- 設定 ---
 # PyInstallerでバンドルされているかどうかでFFmpeg/FFprobeのパスを切り替える
 if getattr(sys, 'frozen', False):
@@ -52,6 +84,10 @@ else:
     FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
     FFPROBE_PATH = os.environ.get("FFPROBE_PATH", "ffprobe")
 
+# アプリケーションのデータフォルダ (main.pyのログや設定と同じ場所)
+APP_NAME = "MP4toGIFConverter"
+APP_DATA_DIR = Path.home() / f".{APP_NAME.lower()}"
+
 # 実行ファイルの存在チェック
 if (not os.path.exists(FFMPEG_PATH) and shutil.which(FFMPEG_PATH) is None) or \
    (not os.path.exists(FFPROBE_PATH) and shutil.which(FFPROBE_PATH) is None):
@@ -61,8 +97,6 @@ if (not os.path.exists(FFMPEG_PATH) and shutil.which(FFMPEG_PATH) is None) or \
     # ベストエフォートでログファイルにも書き込む
     # この時点ではmain.pyのロガー設定が完了していないため、手動で書き込む
     try:
-        APP_NAME = "MP4toGIFConverter"
-        APP_DATA_DIR = Path.home() / f".{APP_NAME.lower()}"
         APP_DATA_DIR.mkdir(exist_ok=True)
         LOG_FILE = APP_DATA_DIR / 'critical_errors.log'
         with open(LOG_FILE, 'a', encoding='utf-8') as f:
@@ -72,6 +106,14 @@ if (not os.path.exists(FFMPEG_PATH) and shutil.which(FFMPEG_PATH) is None) or \
         pass
     sys.exit(1)
 
+# 実行ファイルを絶対パスに解決しておく。PATH検索が不要になり、subprocessが
+# fork+execではなくposix_spawnを使えるようになる (POSIXではclose_fds=Falseと併用)。
+FFMPEG_PATH = os.path.abspath(FFMPEG_PATH) if os.path.exists(FFMPEG_PATH) else shutil.which(FFMPEG_PATH)
+FFPROBE_PATH = os.path.abspath(FFPROBE_PATH) if os.path.exists(FFPROBE_PATH) else shutil.which(FFPROBE_PATH)
+# close_fds=Falseにするのは、posix_spawnが使えるPOSIXだけにする。Windowsで無効にすると
+# 継承するハンドルの制限 (handle_list) がなくなり、同時に起動した子プロセス同士がパイプを継承してしまう。
+SUBPROCESS_CLOSE_FDS = os.name != 'posix'
+
 
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
@@ -81,30 +123,139 @@ app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# タスクの状態を保存するためのインメモリ辞書 (ローカル版の簡易DB)
-tasks_db = {}
+# 同時に実行するFFmpegプロセス数の上限。FFmpegは1プロセスで全コアを使おうとするため、
+# 同時変換数とプロセスあたりのスレッド数を制限してCPUの奪い合いを防ぐ。
+MAX_CONCURRENT_CONVERSIONS = int(os.getenv("MAX_CONCURRENT_CONVERSIONS", str(max(1, (os.cpu_count() or 1) // 4))))
+FFMPEG_THREADS_PER_JOB = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_CONVERSIONS)
+# fps/scale(lanczos)/paletteuseはフィルタースレッドで並列化できるため、
+# デコード・フィルター処理にも同じスレッド数を割り当てる (コマンド先頭に付ける)
+FFMPEG_THREAD_ARGS = [
+    '-filter_threads', str(FFMPEG_THREADS_PER_JOB),
+    '-filter_complex_threads', str(FFMPEG_THREADS_PER_JOB),
+    '-threads', str(FFMPEG_THREADS_PER_JOB),
+]
+
+# 高品質モードのパレットのキャッシュ。同じ動画を同じ区間・設定で再変換する際に
+# パレット生成 (palettegen) を省略する。作成できない環境ではキャッシュを無効にする。
+PALETTE_CACHE_MAX_BYTES = 100 * 1024 * 1024
+try:
+    PALETTE_CACHE_DIR = APP_DATA_DIR / "palette_cache"
+    PALETTE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+except Exception:
+    PALETTE_CACHE_DIR = None
+
+@dataclass
+class TaskState:
+    """
+    1つのタスクの状態を保持するデータクラス。
+    ワーカーは各属性を個別に書き換え、/status は読み取るだけなのでロックは不要。
+    (CPythonでは辞書の取得・代入や属性の代入は単一操作としてアトミック)
+    """
+    state: str
+    progress: int = 0
+    step: str = ""
+    output_path: str = ""
+    error: str = ""
+
+# タスクIDからTaskStateへのインメモリ辞書 (ローカル版の簡易DB)
+tasks_db: dict[str, TaskState] = {}
+# タスクの状態が変わったことを /events のストリームに知らせるためのイベント
+task_events: dict[str, threading.Event] = {}
+# 変換待ち・変換中のタスクID。終了確認のたびに履歴全体を走査しなくて済むよう、別に管理する。
+running_tasks: set[str] = set()
+
+def has_running_tasks() -> bool:
+    """変換待ち・変換中のタスクがあればTrueを返す。"""
+    return bool(running_tasks)
+
+# 以前のタスク履歴を読み込むスレッド。起動 (ウィンドウの表示) を待たせないよう、バックグラウンドで読み込む。
+_tasks_loader_thread: threading.Thread | None = None
+
+def load_tasks_in_background(loader) -> None:
+    """タスク履歴の読み込み関数を別スレッドで開始する。"""
+    global _tasks_loader_thread
+    _tasks_loader_thread = threading.Thread(target=loader, name="tasks-loader", daemon=True)
+    _tasks_loader_thread.start()
+
+def ensure_tasks_loaded() -> None:
+    """タスク履歴の読み込み中であれば、完了するまで待つ。"""
+    if _tasks_loader_thread is not None:
+        _tasks_loader_thread.join()
+
+def discard_pending_task(task_id: str) -> None:
+    """変換を開始できなかったタスクの登録を取り消す。"""
+    tasks_db.pop(task_id, None)
+    task_events.pop(task_id, None)
+    running_tasks.discard(task_id)
+
+def notify_task_changed(task_id: str) -> None:
+    """タスクの状態を更新した後に呼び出し、待機中のSSEストリームを起こす。"""
+    event = task_events.get(task_id)
+    if event:
+        event.set()
 
 # このモジュール用のロガーインスタンスを取得
 logger = logging.getLogger(__name__)
 
+# ファイル名から削除する文字 (パス区切り文字と、Windowsでファイル名として使えない文字)
+_SANITIZE_TABLE = str.maketrans('', '', '/\\<>:"|?*')
+
 def sanitize_filename(filename: str) -> str:
     """
     ファイル名からパス区切り文字などの危険な文字を削除する。
     werkzeugのsecure_filenameと違い、非ASCII文字は保持する。
     """
-    # パス区切り文字を削除
-    sanitized = filename.replace('/', '').replace('\\', '')
-    # Windowsでファイル名として使えない文字をいくつか削除
-    for char in '<>:"|?*':
-        sanitized = sanitized.replace(char, '')
-    # 先頭や末尾の空白、ドットを削除
-    sanitized = sanitized.strip(' .')
+    # 危険な文字を1回の走査で削除し、先頭や末尾の空白、ドットを削除
+    sanitized = filename.translate(_SANITIZE_TABLE).strip(' .')
     # ファイル名が空になった場合のフォールバック
     if not sanitized:
         return f"converted_{uuid.uuid4().hex[:8]}"
     return sanitized
 
+def is_mp4_file(path: str) -> bool:
+    """
+    ファイル先頭12バイトを読み、MP4 (ISOBMFF) のftypボックスで始まっているか確認する。
+    拡張子だけ.mp4に変えた別形式のファイルを、FFmpegを起動する前に弾くために使う。
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(12)
+    except OSError:
+        return False
+    return head[4:8] == b'ftyp'
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    srcをdstとして作業フォルダに配置する。
+    同一ファイルシステムならハードリンク (メタデータのみでファイルサイズに依存しない)、
+    不可ならシンボリックリンク、それも不可なら通常のコピーにフォールバックする。
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return
+    except OSError:
+        pass
+    shutil.copy(src, dst)
+
 def get_video_duration(ffprobe_path: str, video_path: str) -> float | None:
+    """
+    動画の長さを秒単位で取得する。
+    PyAVが利用できればプロセス内でコンテナを解析し、失敗した場合のみffprobeを使う。
+    """
+    if av is not None:
+        try:
+            with av.open(video_path) as container:
+                return float(container.duration) / av.time_base if container.duration else None
+        except (av.error.FFmpegError, OSError) as e:
+            logger.warning(f"PyAV could not read duration for '{video_path}', falling back to ffprobe. Error: {e}")
+    return _get_video_duration_with_ffprobe(ffprobe_path, video_path)
+
+def _get_video_duration_with_ffprobe(ffprobe_path: str, video_path: str) -> float | None:
     """ffprobeを使って動画の長さを秒単位で取得する。"""
     command = [
         ffprobe_path, '-v', 'error', '-show_entries', 'format=duration',
@@ -112,14 +263,15 @@ def get_video_duration(ffprobe_path: str, video_path: str) -> float | None:
     ]
     try:
         result = subprocess.run(
-            command, capture_output=True, text=True, check=True, encoding='utf-8',
+            command, capture_output=True, check=True, # 出力は数値のみなのでデコードしない
+            close_fds=SUBPROCESS_CLOSE_FDS, # POSIXではposix_spawnを使わせる (Pythonが開くFDは既定で継承されない)
             creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
         )
-        return float(result.stdout.strip())
+        return float(result.stdout)
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         logger.error(f"Failed to get video duration for '{video_path}'. Error: {e}", exc_info=True)
         if isinstance(e, subprocess.CalledProcessError):
-            logger.error(f"ffprobe stderr: {e.stderr}")
+            logger.error(f"ffprobe stderr: {e.stderr.decode('utf-8', errors='replace') if e.stderr else 'N/A'}")
         return None
 
 @dataclass
@@ -127,6 +279,7 @@ class ConversionJob:
     """変換ジョブのパラメータを保持するデータクラス"""
     ffmpeg_path: str
     input_path: str
+    original_input_path: str
     output_path: str
     start_time: float
     end_time: float | None
@@ -135,52 +288,293 @@ class ConversionJob:
     conversion_duration: float
     high_quality: bool
 
-def conversion_worker_thread(task_id: str, job: ConversionJob):
+def get_palette_cache_path(job: ConversionJob) -> Path | None:
+    """入力ファイルと変換設定から、キャッシュされたパレットのパスを求める。"""
+    if PALETTE_CACHE_DIR is None:
+        return None
+    # 作業フォルダのinput_pathはコピーになる場合があり、変換のたびに更新日時が変わるため、
+    # ユーザーが選んだ元のファイルでキーを作る
+    try:
+        stat = os.stat(job.original_input_path)
+    except OSError:
+        return None
+    key = hashlib.sha1(
+        f"{job.original_input_path}|{stat.st_size}|{stat.st_mtime_ns}|{job.start_time}|{job.end_time}|{job.fps}|{job.width}".encode()
+    ).hexdigest()
+    return PALETTE_CACHE_DIR / f"{key}.png"
+
+def prune_palette_cache() -> None:
+    """パレットキャッシュの合計サイズが上限を超えたら、古いもの (更新日時順) から削除する。"""
+    try:
+        entries = []
+        for entry in os.scandir(PALETTE_CACHE_DIR):
+            # 書き出し途中の一時ファイルは対象外
+            if entry.is_file() and entry.name.endswith('.png') and not entry.name.endswith('.tmp.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+    except OSError as e:
+        logger.warning(f"Could not scan palette cache: {e}")
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= PALETTE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            logger.warning(f"Could not remove cached palette {path}: {e}")
+
+def build_ffmpeg_command(job: ConversionJob, palette_path: Path | None = None, reuse_palette: bool = False) -> list[str]:
     """
-    変換処理をバックグラウンドのスレッドで実行し、辞書の状態を更新する。
+    1つのジョブを変換するFFmpegコマンドを組み立てる。
+    高品質モードでpalette_pathが指定された場合、reuse_paletteならそのパレットを入力として使い、
+    そうでなければ生成したパレットをGIFと同時にpalette_pathへ書き出す。
     """
-    input_path = job.input_path
-    
-    # 進捗を辞書に書き込むためのコールバック関数を定義
-    def progress_callback(progress, step):
-        if task_id in tasks_db:
-            tasks_db[task_id].update({'progress': progress, 'step': step})
-    
-    # --- FFmpegコマンドの組み立て ---
     # 外部ライブラリに依存せず、直接コマンドを生成することでエラーハンドリングを堅牢にします。
     command = [
         job.ffmpeg_path,
+        *FFMPEG_THREAD_ARGS,  # フィルター・デコードのスレッド数
+        '-nostats',  # 進捗の統計表示は使わないので出力しない
         '-y',  # 出力ファイルを常に上書き
         '-ss', str(job.start_time), # 開始時間
-        '-i', job.input_path,      # 入力ファイル
     ]
     if job.end_time is not None:
-        command.extend(['-to', str(job.end_time)]) # 終了時間
+        # 区間の長さで入力側を切り詰める (パレットの出力にも同じ区間が適用されるように)
+        command.extend(['-t', str(job.end_time - job.start_time)])
+    command.extend(['-i', job.input_path]) # 入力ファイル
 
     # ビデオフィルターの設定
-    filters = [
-        f"fps={job.fps}",
-        f"scale={job.width}:-1:flags=lanczos",
-    ]
-    if job.high_quality:
-        # 高品質モード用のフィルター（2パス処理）
-        filters.append("split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse")
-    
-    command.extend(['-vf', ','.join(filters)])
-    command.append(job.output_path) # 出力ファイル
+    scale_filter = f"fps={job.fps},scale={job.width}:-1:flags=lanczos"
+    threads = ['-threads', str(FFMPEG_THREADS_PER_JOB)] # プロセスあたりのスレッド数
+
+    if not job.high_quality:
+        command.extend(['-vf', scale_filter, *threads, job.output_path])
+    elif palette_path is None:
+        # 高品質モード用のフィルター（パレット生成と適用を1回の実行で行う）
+        command.extend(['-vf', f"{scale_filter},split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse", *threads, job.output_path])
+    elif reuse_palette:
+        # キャッシュ済みのパレットを2つ目の入力として適用する
+        command.extend([
+            '-i', str(palette_path),
+            '-filter_complex', f"[0:v]{scale_filter}[x];[x][1:v]paletteuse",
+            *threads, job.output_path,
+        ])
+    else:
+        # パレットを生成してGIFに適用しつつ、同じパレットをキャッシュ用に書き出す
+        command.extend([
+            '-filter_complex', f"[0:v]{scale_filter},split[s0][s1];[s0]palettegen,split[p][pc];[s1][p]paletteuse[o]",
+            '-map', '[o]', *threads, job.output_path,
+            '-map', '[pc]', '-frames:v', '1', '-update', '1', str(palette_path),
+        ])
+    return command
+
+def build_batch_ffmpeg_command(jobs: list[ConversionJob]) -> list[str]:
+    """
+    複数のジョブを1回のFFmpeg実行で変換するコマンドを組み立てる。
+    入力ごとにトリミングし、-filter_complexで入力iから出力iへのフィルターを並べる。
+    """
+    command = [jobs[0].ffmpeg_path, *FFMPEG_THREAD_ARGS, '-nostats', '-y']
+    graphs = []
+    for i, job in enumerate(jobs):
+        command.extend(['-ss', str(job.start_time)])
+        if job.end_time is not None:
+            command.extend(['-t', str(job.end_time - job.start_time)])
+        command.extend(['-i', job.input_path])
+
+        graph = f"[{i}:v]fps={job.fps},scale={job.width}:-1:flags=lanczos"
+        if job.high_quality:
+            graph += f",split[a{i}][b{i}];[a{i}]palettegen[p{i}];[b{i}][p{i}]paletteuse"
+        graphs.append(f"{graph}[o{i}]")
+
+    command.extend(['-filter_complex', ';'.join(graphs)])
+    for i, job in enumerate(jobs):
+        command.extend(['-map', f"[o{i}]", '-threads', str(FFMPEG_THREADS_PER_JOB), job.output_path])
+    return command
+
+def run_ffmpeg(command: list[str]) -> None:
+    """FFmpegを実行し、失敗した場合はCalledProcessErrorを送出する。"""
+    # エラーがあれば例外を発生させる (check=True)
+    # これにより、FFmpegからのエラーメッセージを確実に捕捉できます。
+    # 呼び出し元はCONVERSION_EXECUTORのワーカーだけなので、同時実行数はプールのサイズで制限される。
+    subprocess.run(
+        command,
+        check=True,
+        capture_output=True, # stdoutとstderrをキャプチャして例外オブジェクトに含める
+        close_fds=SUBPROCESS_CLOSE_FDS, # POSIXではposix_spawnを使わせる (Pythonが開くFDは既定で継承されない)
+        creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0 # Windowsでコンソール非表示
+    )
+
+def convert_single_job(job: ConversionJob) -> None:
+    """1つのジョブを変換する。高品質モードではパレットキャッシュを利用・更新する。"""
+    palette_path = get_palette_cache_path(job) if job.high_quality else None
+    if palette_path is None:
+        run_ffmpeg(build_ffmpeg_command(job))
+        return
 
+    if palette_path.exists():
+        try:
+            os.utime(palette_path) # 最近使ったものとして更新日時を更新する
+            run_ffmpeg(build_ffmpeg_command(job, palette_path, reuse_palette=True))
+            return
+        except (OSError, subprocess.CalledProcessError) as e:
+            # キャッシュが壊れている可能性があるため、破棄してパレットから作り直す
+            logger.warning(f"Cached palette {palette_path} could not be used, regenerating: {e}")
+            try:
+                os.remove(palette_path)
+            except OSError:
+                pass
+
+    # 書き出し途中のパレットがキャッシュとして使われないよう、一時ファイルに書いてから置き換える
+    temp_palette_path = palette_path.with_name(f"{palette_path.stem}.{uuid.uuid4().hex[:8]}.tmp.png")
     try:
-        # FFmpegプロセスを直接実行し、エラーがあれば例外を発生させる (check=True)
-        # これにより、FFmpegからのエラーメッセージを確実に捕捉できます。
-        subprocess.run(
-            command,
-            check=True,
-            capture_output=True, # stdoutとstderrをキャプチャして例外オブジェクトに含める
-            creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0 # Windowsでコンソール非表示
-        )
+        run_ffmpeg(build_ffmpeg_command(job, temp_palette_path))
+        if temp_palette_path.exists():
+            os.replace(temp_palette_path, palette_path)
+            prune_palette_cache()
+    finally:
+        try:
+            if temp_palette_path.exists():
+                os.remove(temp_palette_path)
+        except OSError as e:
+            logger.warning(f"Could not clean up temporary palette {temp_palette_path}: {e}")
+
+class JobBatcher:
+    """
+    短い時間内に投入された変換ジョブを1回のFFmpeg実行にまとめるクラス。
+    FFmpegの起動と初期化のコストをジョブ間で分け合うことができる。
+    ジョブが1件だけのときは通常の単一ジョブ用コマンドで実行する。
+    バッチはスレッドプールで実行し、実行中のバッチがmax_running件に達している間は次のバッチを作らずに待つ。
+    """
+    def __init__(self, executor: ThreadPoolExecutor, max_running: int, window_seconds: float = 0.25, max_batch_size: int = 4):
+        self._executor = executor
+        self._running_slots = threading.BoundedSemaphore(max_running)
+        self._window_seconds = window_seconds
+        self._max_batch_size = max_batch_size
+        self._queue: queue.Queue[tuple[ConversionJob, Future]] = queue.Queue()
+        threading.Thread(target=self._collect_loop, name="job-batcher", daemon=True).start()
+
+    def submit(self, job: ConversionJob) -> Future:
+        """ジョブを投入し、変換完了時に結果が設定されるFutureを返す。"""
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    def _collect_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # 空きを待っている間に届いたジョブは、続けて同じバッチにまとめられる
+            self._running_slots.acquire()
+            deadline = time.monotonic() + self._window_seconds
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                future = self._executor.submit(self._run_batch, batch)
+            except RuntimeError as e:
+                # 終了処理でスレッドプールが停止済み
+                self._running_slots.release()
+                for _, job_future in batch:
+                    job_future.set_exception(e)
+                continue
+            future.add_done_callback(lambda _: self._running_slots.release())
+
+    def _run_batch(self, batch: list[tuple[ConversionJob, Future]]):
+        if len(batch) > 1:
+            try:
+                run_ffmpeg(build_batch_ffmpeg_command([job for job, _ in batch]))
+            except Exception as e:
+                # 1つの入力の不具合で全ジョブが失敗しないよう、個別実行にフォールバックする
+                logger.warning(f"Batched conversion of {len(batch)} jobs failed, retrying individually: {e}")
+            else:
+                for job, future in batch:
+                    future.set_result(job.output_path)
+                return
+
+        for job, future in batch:
+            try:
+                convert_single_job(job)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(job.output_path)
+
+# バッチを実行するスレッドプール。バッチごとにスレッドを作らずに再利用する。
+# 1つのワーカーが同時に動かすFFmpegは1プロセスだけなので、プールのサイズが同時変換数の上限になる。
+CONVERSION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_CONVERSIONS, thread_name_prefix="conv"
+)
+
+# 変換ジョブはすべてこのバッチャー経由で実行する
+BATCH_MAX_SIZE = 4
+JOB_BATCHER = JobBatcher(CONVERSION_EXECUTOR, MAX_CONCURRENT_CONVERSIONS, max_batch_size=BATCH_MAX_SIZE)
+
+def shutdown_conversion_executor() -> None:
+    """未着手の変換タスクを取り消し、スレッドプールを停止する (実行中の変換は待たない)。"""
+    CONVERSION_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(shutdown_conversion_executor)
+
+# 一時ファイルの定期削除の設定
+SWEEP_INTERVAL_SECONDS = 300
+SWEEP_MAX_AGE_SECONDS = 3600
+
+def sweep_stale_files() -> None:
+    """
+    作業フォルダに残った古いファイルを削除する。
+    ダウンロード中の切断などで削除されずに残ったファイルが溜まり続けるのを防ぐ。
+    出力フォルダはWebアプリモードのときだけ対象にする (デスクトップ版では保存先になりうるため)。
+    """
+    folders = [app.config['UPLOAD_FOLDER']]
+    if not app.config.get('IS_DESKTOP_APP'):
+        folders.append(app.config['OUTPUT_FOLDER'])
+
+    now = time.time()
+    for folder in folders:
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    # 変換待ち・変換中のタスクの入力ファイルは残す
+                    task = tasks_db.get(os.path.splitext(entry.name)[0])
+                    if task and task.state not in ('SUCCESS', 'FAILURE'):
+                        continue
+                    try:
+                        # シンボリックリンクはリンク自体の更新日時で判定する
+                        stat = entry.stat(follow_symlinks=False)
+                        if entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                            if now - stat.st_mtime > SWEEP_MAX_AGE_SECONDS:
+                                os.unlink(entry.path)
+                    except OSError:
+                        pass
+        except OSError as e:
+            logger.warning(f"Could not sweep folder {folder}: {e}")
+
+def _sweeper_loop() -> None:
+    while True:
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+        sweep_stale_files()
+
+threading.Thread(target=_sweeper_loop, name="file-sweeper", daemon=True).start()
+
+def finish_conversion_task(task_id: str, job: ConversionJob, future: Future):
+    """
+    バッチャーでの変換が終わったときに呼ばれ、辞書の状態を更新する。
+    """
+    input_path = job.input_path
+    
+    try:
+        # FFmpegが失敗した場合はCalledProcessErrorがそのまま送出される。
+        future.result()
         # 成功したら状態を更新
-        tasks_db[task_id]['state'] = 'SUCCESS'
-        tasks_db[task_id]['output_path'] = job.output_path
+        tasks_db[task_id].output_path = job.output_path
+        tasks_db[task_id].state = 'SUCCESS'
+        notify_task_changed(task_id)
         logger.info(f"Task {task_id} completed successfully. Output: {job.output_path}")
     except subprocess.CalledProcessError as e:
         # FFmpegが0以外の終了コードを返して失敗した場合の特別な処理
@@ -194,8 +588,9 @@ def conversion_worker_thread(task_id: str, job: ConversionJob):
             f"FFmpeg Command: {' '.join(map(str, e.cmd))}\n"
             f"FFmpeg stderr:\n{ffmpeg_error_output}"
         )
-        tasks_db[task_id]['state'] = 'FAILURE'
-        tasks_db[task_id]['error'] = error_message_for_ui
+        tasks_db[task_id].error = error_message_for_ui
+        tasks_db[task_id].state = 'FAILURE'
+        notify_task_changed(task_id)
     except Exception as e:
         # FFmpeg以外の予期せぬエラーが発生した場合
         # UIにはエラーの種別がわかる程度のメッセージを表示
@@ -206,23 +601,33 @@ def conversion_worker_thread(task_id: str, job: ConversionJob):
             f"Conversion failed for task {task_id}. Input: {job.input_path}",
             exc_info=True  # この引数がスタックトレースをログに追加する
         )
-        tasks_db[task_id]['state'] = 'FAILURE'
-        tasks_db[task_id]['error'] = error_message_for_ui
+        tasks_db[task_id].error = error_message_for_ui
+        tasks_db[task_id].state = 'FAILURE'
+        notify_task_changed(task_id)
     finally:
+        running_tasks.discard(task_id)
+        # 完了後は通知先が不要になるため破棄する (接続中のストリームは参照を保持している)
+        task_events.pop(task_id, None)
         # 変換が成功しても失敗しても、入力ファイルを削除する
+        # (input_pathは作業フォルダ内のリンクまたはコピーなので、削除しても元の動画は残る)
         try:
             if os.path.exists(input_path):
                 os.remove(input_path)
         except OSError as e:
             logger.warning(f"Could not clean up input file {input_path}: {e}")
 
+# テンプレートは実行時に変化しないため、起動時に一度だけレンダリングしておく
+with app.app_context():
+    _INDEX_HTML = render_template('index.html').encode('utf-8')
+    _LICENSES_HTML = render_template('licenses.html').encode('utf-8')
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return Response(_INDEX_HTML, mimetype='text/html')
 
 @app.route('/licenses')
 def licenses():
-    return render_template('licenses.html')
+    return Response(_LICENSES_HTML, mimetype='text/html')
 
 @app.route('/favicon.ico')
 def favicon():
@@ -242,7 +647,7 @@ def load_video():
     if not video_path or not os.path.exists(video_path):
         return jsonify({"error": "File not found"}), 404
     
-    if not video_path.lower().endswith('.mp4'):
+    if not video_path.lower().endswith('.mp4') or not is_mp4_file(video_path):
         return jsonify({"error": "Invalid file type. Only MP4 is supported."}), 400
 
     try:
@@ -275,6 +680,8 @@ def open_folder_route():
 
 @app.route('/convert', methods=['POST'])
 def start_conversion_task():
+    # 履歴の読み込みより先に新しいタスクを追加すると、履歴の挿入順が時系列でなくなるため待つ
+    ensure_tasks_loaded()
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON request"}), 400
@@ -283,6 +690,9 @@ def start_conversion_task():
     if not original_input_path or not os.path.exists(original_input_path):
         return jsonify({"error": "Input file not found or path not provided"}), 400
 
+    if not is_mp4_file(original_input_path):
+        return jsonify({"error": "Invalid file type. Only MP4 is supported."}), 400
+
     original_filename = os.path.basename(original_input_path)
 
     try:
@@ -298,11 +708,21 @@ def start_conversion_task():
         return jsonify({"error": "Invalid parameter type"}), 400
 
     task_id = str(uuid.uuid4())
+
+    # 作業フォルダにファイルを作る前にタスクを登録しておく。
+    # ハードリンクは元のファイルの古い更新日時を引き継ぐため、登録前に定期削除が走ると消されてしまう。
+    tasks_db[task_id] = TaskState(state='PENDING')
+    task_events[task_id] = threading.Event()
+    running_tasks.add(task_id)
     
-    # 元のファイルを直接使わず、安全な場所にコピーして処理する
+    # 元のファイルを直接使わず、作業フォルダにリンク (不可ならコピー) を作って処理する
     _, extension = os.path.splitext(original_filename)
     input_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{task_id}{extension}")
-    shutil.copy(original_input_path, input_path)
+    try:
+        link_or_copy(original_input_path, input_path)
+    except Exception:
+        discard_pending_task(task_id)
+        raise
 
     # 保存先フォルダを決定
     save_dir = output_dir_from_form if output_dir_from_form and output_dir_from_form.strip() else app.config['OUTPUT_FOLDER']
@@ -318,29 +738,32 @@ def start_conversion_task():
         final_filename = f"{task_id}.gif"
     output_path = os.path.join(save_dir, final_filename)
 
-    # 進捗計算のために動画の長さを取得
-    video_duration = get_video_duration(FFPROBE_PATH, input_path)
-    if video_duration is None:
-        os.remove(input_path)
-        return jsonify({"error": "Could not get video information."}), 500
-
+    # 変換区間の長さを決定する
     if end_time is not None:
-        actual_end_time = min(end_time, video_duration)
-        conversion_duration = actual_end_time - start_time
+        # 終了時間が指定されていればそれを正とし、ffprobeの起動を省く
+        # (動画の長さを超えていてもFFmpeg側で入力の終端までに切り詰められる)
+        conversion_duration = end_time - start_time
     else:
+        # 終了時間の指定がない場合のみ、動画の長さを取得する
+        video_duration = get_video_duration(FFPROBE_PATH, input_path)
+        if video_duration is None:
+            os.remove(input_path)
+            discard_pending_task(task_id)
+            return jsonify({"error": "Could not get video information."}), 500
         conversion_duration = video_duration - start_time
 
     if conversion_duration <= 0:
         os.remove(input_path)
+        discard_pending_task(task_id)
         return jsonify({"error": "Conversion duration must be positive."}), 400
 
-    # タスクの初期状態を辞書に保存
-    tasks_db[task_id] = {'state': 'PENDING', 'output_path': output_path}
+    tasks_db[task_id].output_path = output_path
 
     # 変換ジョブのパラメータをデータクラスにまとめる
     job = ConversionJob(
         ffmpeg_path=FFMPEG_PATH,
         input_path=input_path,
+        original_input_path=original_input_path,
         output_path=output_path,
         start_time=start_time,
         end_time=end_time,
@@ -350,48 +773,70 @@ def start_conversion_task():
         high_quality=high_quality,
     )
 
-    # バックグラウンドスレッドで変換を開始
-    thread = threading.Thread(target=conversion_worker_thread, args=(task_id, job))
-    thread.daemon = True
-    thread.start()
+    # バッチャーに投入し、変換が終わったら状態を更新する
+    JOB_BATCHER.submit(job).add_done_callback(lambda future: finish_conversion_task(task_id, job, future))
 
-    return jsonify({"task_id": task_id, "status_url": url_for('get_task_status', task_id=task_id)}), 202
+    return jsonify({
+        "task_id": task_id,
+        "status_url": url_for('get_task_status', task_id=task_id),
+        "events_url": url_for('task_events_stream', task_id=task_id),
+    }), 202
 
-@app.route('/status/<task_id>')
-def get_task_status(task_id):
-    task_info = tasks_db.get(task_id)
-    if not task_info:
-        return jsonify({'state': 'NOT_FOUND'}), 404
-    
-    response_data = task_info.copy()
+def build_status_data(task_info: TaskState) -> dict:
+    """/status と /events で返すタスク状態の辞書を組み立てる。"""
+    response_data = asdict(task_info)
     response_data['is_desktop_app'] = app.config.get('IS_DESKTOP_APP', False)
 
     # Webアプリモードの場合のみダウンロードURLを生成
     if not response_data['is_desktop_app'] and response_data.get('state') == 'SUCCESS':
         filename = os.path.basename(response_data['output_path'])
         response_data['download_url'] = url_for('download_gif', filename=filename)
-    return jsonify(response_data)
+    return response_data
+
+@app.route('/status/<task_id>')
+def get_task_status(task_id):
+    ensure_tasks_loaded()
+    task_info = tasks_db.get(task_id)
+    if not task_info:
+        return jsonify({'state': 'NOT_FOUND'}), 404
+    return jsonify(build_status_data(task_info))
+
+@app.route('/events/<task_id>')
+def task_events_stream(task_id):
+    """
+    タスクの状態をServer-Sent Eventsで配信する。
+    ワーカーが状態を更新するたびに送信し、完了 (成功/失敗) したらストリームを閉じる。
+    """
+    ensure_tasks_loaded()
+    if task_id not in tasks_db:
+        return jsonify({'state': 'NOT_FOUND'}), 404
+    event = task_events.get(task_id)
+
+    def generate():
+        while True:
+            # 先にクリアしてから状態を読むことで、読み取り後の更新を取りこぼさない
+            if event:
+                event.clear()
+            task_info = tasks_db.get(task_id)
+            if not task_info:
+                return
+            yield f"data: {app.json.dumps(build_status_data(task_info))}\n\n"
+            if event is None or task_info.state in ('SUCCESS', 'FAILURE'):
+                return
+            # 更新がなくても一定間隔で現在の状態を送り、接続を維持する
+            event.wait(timeout=15)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache"
+    })
+
 @app.route('/download/<filename>')
 def download_gif(filename):
-    path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+    # send_fileは相対パスをapp.root_path基準で解決するため、存在確認と同じ絶対パスを渡す
+    path = os.path.abspath(os.path.join(app.config['OUTPUT_FOLDER'], filename))
     if not os.path.exists(path):
         return jsonify({"error": "File not found or already deleted."}), 404
     
-    def generate():
-        """ファイルをストリーミングし、完了後に削除するジェネレータ"""
-        try:
-            with open(path, 'rb') as f:
-                yield from f
-        finally:
-            # デスクトップアプリモードでなければファイルを削除
-            if not app.config.get('IS_DESKTOP_APP'):
-                try:
-                    if os.path.exists(path):
-                        os.remove(path)
-                except OSError as e:
-                    logger.error(f"Failed to delete temporary file: {e}", exc_info=True)
-
-    # ストリーミングでレスポンスを返し、ダウンロードダイアログをトリガーする
-    return Response(stream_with_context(generate()), mimetype='image/gif', headers={
-        "Content-Disposition": f"attachment; filename={filename}"
-    })
+    # send_fileはWSGIサーバーのfile_wrapper (sendfile) を使えるため、Python側でのコピーが不要
+    # (Webアプリモードで残った出力ファイルは、sweep_stale_filesが定期的に削除する)
+    return send_file(path, mimetype='image/gif', as_attachment=True, download_name=filename)
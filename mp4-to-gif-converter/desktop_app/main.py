@@ -1,13 +1,17 @@
 import sys
 import os
 
-import webview
 import json
+try:
+    import orjson  # 高速なJSONライブラリ (なければ標準のjsonにフォールバック)
+except ImportError:
+    orjson = None
 from pathlib import Path
 import logging
-import subprocess
-import logging.handlers
-from app import app, tasks_db
+import threading
+import logging.handlers  # BufferedRotatingFileHandlerの基底クラスのため、モジュール読み込み時に必要
+from dataclasses import asdict
+# webview, subprocess, Flaskアプリ (app) の読み込みは重いため、実際に使う関数の中でインポートする
 
 # --- アプリケーションデータディレクトリの設定 ---
 # ユーザーの環境を汚さないよう、設定ファイルは専用のフォルダに保存します。
@@ -23,9 +27,53 @@ except Exception as e:
     # この時点ではロガーが未設定のため、標準エラー出力にフォールバック
     print(f"CRITICAL: Could not create app data directory in home, falling back to current dir: {e}", file=sys.stderr)
     APP_DATA_DIR = Path('.')
+# フォルダを開く際などに使う絶対パスは、起動時に一度だけ解決しておく
+APP_DATA_DIR_STR = str(APP_DATA_DIR.resolve())
+
+# OSのファイルエクスプローラーでフォルダを開くコマンド (Windowsはos.startfileを使うためNone)
+_OPEN_CMD = {'win32': None, 'darwin': ['open']}.get(sys.platform, ['xdg-open'])
 
 # --- ロギング設定 ---
 LOG_FILE = APP_DATA_DIR / 'app.log'
+# ログファイルの書き込みバッファサイズ。変換中の大量のINFO/DEBUGログを1行ごとに書き込まないようにする。
+LOG_BUFFER_SIZE = 64 * 1024
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    書き込みをバッファリングするRotatingFileHandler。
+    WARNING以上のレコードだけ即座にフラッシュし、それ以外はバッファが溜まるか終了時に書き出す。
+    """
+    def _open(self):
+        # emitでエンコード済みのバイト列を書き込むため、バイナリモードで開く
+        stream = open(self.baseFilename, self.mode + 'b', buffering=LOG_BUFFER_SIZE)
+        # 標準の実装はローテーション判定のたびにtell()するが、それではバッファが毎回フラッシュされるため、
+        # ファイルサイズは自前で数える
+        self._size = stream.seek(0, os.SEEK_END)
+        return stream
+
+    def emit(self, record):
+        try:
+            # 整形とエンコードはレコードごとに1回だけ行い、そのバイト数でローテーションを判定する
+            data = (self.format(record) + self.terminator).encode(self.encoding or 'utf-8', self.errors or 'replace')
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self._size + len(data) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(data)
+            self._size += len(data)
+            if record.levelno >= logging.WARNING:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+def flush_log_handlers():
+    """バッファに残っているログをファイルに書き出す。"""
+    for handler in logging.getLogger().handlers:
+        handler.flush()
 
 def setup_logging(is_debug=False):
     """アプリケーションのロギングを設定する"""
@@ -44,8 +92,9 @@ def setup_logging(is_debug=False):
 
     # ファイルハンドラの設定 (ログローテーション付き)
     # 1MBごとにファイルを分け、5世代までバックアップを保持
+    # (バッファは終了時にloggingモジュールがatexitで登録しているlogging.shutdownでも書き出される)
     try:
-        file_handler = logging.handlers.RotatingFileHandler(
+        file_handler = BufferedRotatingFileHandler(
             LOG_FILE, maxBytes=1024*1024, backupCount=5, encoding='utf-8'
         )
         file_handler.setFormatter(formatter)
@@ -55,19 +104,44 @@ def setup_logging(is_debug=False):
 
     logging.info("--- Application Starting ---")
 
+def read_json_file(path):
+    """JSONファイルを読み込む。orjsonが使えればそちらで解析する。"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    # orjson.JSONDecodeErrorはjson.JSONDecodeErrorのサブクラスなので、呼び出し側の例外処理は共通
+    return orjson.loads(data) if orjson else json.loads(data)
+
+# fdatasyncはWindows/macOSにはないため、その場合はfsyncを使う
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+def write_json_file(path, obj):
+    """
+    オブジェクトをインデント付きのUTF-8 JSONとしてファイルに書き込む。
+    一時ファイルに書いてディスクに同期してから置き換えるため、
+    強制終了や電源断が起きても書き込み途中の壊れたファイルが残らない。
+    """
+    if orjson:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    else:
+        data = (json.dumps(obj, indent=2, ensure_ascii=False) + '\n').encode('utf-8')
+    temp_path = Path(path).with_suffix('.json.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        _fdatasync(f.fileno())
+    os.replace(temp_path, path)
+
 def load_config():
     """設定ファイルを読み込む"""
     try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return read_json_file(CONFIG_FILE)
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
 def save_config(config):
     """設定ファイルを保存する"""
     try:
-        with open(APP_DATA_DIR / 'pywebview_config.json', 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=2)
+        write_json_file(CONFIG_FILE, config)
     except Exception as e:
         logging.error(f"Error saving config: {e}", exc_info=True)
 
@@ -75,33 +149,93 @@ def save_config(config):
 # 設定ファイルとタスクDBのパスをアプリケーションデータディレクトリ内に設定
 CONFIG_FILE = APP_DATA_DIR / 'pywebview_config.json'
 DB_FILE = APP_DATA_DIR / 'tasks_db.json'
+# 保存直前のタスクDB。本体が壊れていた場合の読み込み元として使う。
+DB_BACKUP_FILE = APP_DATA_DIR / 'tasks_db.json.bak'
+# タスク履歴として保存する最大件数 (新しいものから残す)
+TASK_HISTORY_LIMIT = 200
+
+def compact_task_history(tasks_db):
+    """
+    保存用にタスク履歴を縮小した辞書を返す。
+    tasks_dbは追加順 (古い順) に並んでいるため、末尾のTASK_HISTORY_LIMIT件だけを残す。
+    成功したタスクからは、読み込み時に既定値で復元できる途中経過のフィールドを除く。
+    """
+    compacted = {}
+    for task_id, task in list(tasks_db.items())[-TASK_HISTORY_LIMIT:]:
+        data = asdict(task)
+        if task.state == 'SUCCESS':
+            data.pop('step', None)
+            data.pop('error', None)
+        compacted[task_id] = data
+    return compacted
 
 def save_tasks_on_close():
     """ウィンドウが閉じられた後にタスクDBをJSONファイルに保存します。"""
+    from app import tasks_db, shutdown_conversion_executor, ensure_tasks_loaded
     logging.info("Application closed. Saving task history.")
+    # 履歴の読み込みが終わる前に保存すると以前の履歴が失われるため、完了を待つ
+    ensure_tasks_loaded()
+    # 未着手の変換タスクが終了処理中に実行されないよう、先に取り消しておく
+    shutdown_conversion_executor()
     try:
-        with open(DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(tasks_db, f, indent=2, ensure_ascii=False)
+        # 前回のDBをバックアップとして残してから書き込む
+        if DB_FILE.exists():
+            os.replace(DB_FILE, DB_BACKUP_FILE)
+        write_json_file(DB_FILE, compact_task_history(tasks_db))
     except Exception as e:
         logging.error(f"Failed to save task history on close: {e}", exc_info=True)
 
 def load_tasks_on_startup():
-    """起動時にJSONファイルからタスクDBを読み込みます。"""
-    try:
-        with open(DB_FILE, 'r', encoding='utf-8') as f:
-            tasks_db.update(json.load(f))
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass  # ファイルが存在しない、または空の場合は何もしない
+    """起動時にJSONファイルからタスクDBを読み込みます。本体が読めなければバックアップを使います。"""
+    from app import tasks_db, TaskState
+    for path in (DB_FILE, DB_BACKUP_FILE):
+        try:
+            tasks = read_json_file(path)
+            tasks_db.update({task_id: TaskState(**task) for task_id, task in tasks.items()})
+            return
+        except FileNotFoundError:
+            continue  # ファイルが存在しない場合は次の候補へ
+        except (json.JSONDecodeError, TypeError, AttributeError) as e:
+            logging.warning(f"Could not load task history from {path}: {e}")
 
 class Api:
     """ pywebviewのJS APIとしてフロントエンドに公開するクラス """
+    # 設定を変更してから保存するまでの待ち時間 (秒)。連続した変更を1回の書き込みにまとめる。
+    CONFIG_FLUSH_DELAY = 2.0
+
     def __init__(self):
+        # 設定はメモリ上のself.configを正とし、変更時はdirtyフラグを立てて後でまとめて保存する
         self.config = load_config()
+        self._dirty = False
+        self._config_lock = threading.Lock()
+        self._flush_timer = None
+
+    def _mark_config_dirty(self):
+        """設定が変更されたことを記録し、少し待ってから保存するようにタイマーを設定し直す。"""
+        with self._config_lock:
+            self._dirty = True
+            if self._flush_timer:
+                self._flush_timer.cancel()
+            self._flush_timer = threading.Timer(self.CONFIG_FLUSH_DELAY, self.flush_config)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush_config(self):
+        """未保存の設定変更があればファイルに書き込む。"""
+        with self._config_lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._dirty:
+                return
+            save_config(self.config)
+            self._dirty = False
 
     def select_file(self):
         """
         ファイル選択ダイアログを開き、選択されたファイルのパスを返す。
         """
+        import webview
         window = webview.active_window()
         if not window:
             return None
@@ -116,7 +250,7 @@ class Api:
         if result:
             selected_path = result[0]
             self.config['last_input_dir'] = os.path.dirname(selected_path)
-            save_config(self.config)
+            self._mark_config_dirty()
             return selected_path
         return None
 
@@ -124,6 +258,7 @@ class Api:
         """
         フォルダ選択ダイアログを開き、選択されたフォルダのパスを返す。
         """
+        import webview
         window = webview.active_window()
         if not window:
             return None
@@ -135,7 +270,7 @@ class Api:
         if result:
             selected_path = result[0]
             self.config['last_output_dir'] = selected_path
-            save_config(self.config)
+            self._mark_config_dirty()
             return selected_path
         return None
 
@@ -148,13 +283,11 @@ class Api:
         ログファイルが保存されているフォルダをOSのファイルエクスプローラーで開く。
         """
         try:
-            folder_path = str(APP_DATA_DIR.resolve())
-            if sys.platform == 'win32':
-                os.startfile(folder_path)
-            elif sys.platform == 'darwin': # macOS
-                subprocess.run(['open', folder_path])
-            else: # Linux
-                subprocess.run(['xdg-open', folder_path])
+            if _OPEN_CMD is None: # Windows
+                os.startfile(APP_DATA_DIR_STR)
+            else: # macOS / Linux
+                import subprocess
+                subprocess.run(_OPEN_CMD + [APP_DATA_DIR_STR])
         except Exception as e:
             logging.error(f"Failed to open log folder '{APP_DATA_DIR}': {e}", exc_info=True)
             # フロントエンドにはエラーを返さない。ログに記録されていれば十分。
@@ -164,13 +297,10 @@ def on_closing():
     ウィンドウが閉じられる前に呼び出されるイベントハンドラ。
     変換中のタスクがある場合、ユーザーに終了を確認するダイアログを表示します。
     """
+    import webview
+    from app import has_running_tasks
     # 実行中のタスク（完了または失敗していないタスク）があるか確認
-    is_task_running = any(
-        task.get('state') not in ('SUCCESS', 'FAILURE')
-        for task in tasks_db.values()
-    )
-
-    if is_task_running:
+    if has_running_tasks():
         window = webview.active_window()
         if window:
             confirm_close = window.create_confirmation_dialog(
@@ -180,10 +310,15 @@ def on_closing():
             # ユーザーが「いいえ」(キャンセル) を選択した場合、Falseを返して終了を中止
             if not confirm_close:
                 return False
+    # 終了処理の途中で異常終了してもここまでのログが残るよう、バッファを書き出しておく
+    flush_log_handlers()
     # 実行中のタスクがない場合、またはユーザーが「はい」を選択した場合は、Trueを返して終了を許可
     return True
 
 def main():
+    import webview
+    from app import app, load_tasks_in_background
+
     # コマンドライン引数に '--debug' が含まれていればデバッグモードを有効にする
     is_debug = '--debug' in sys.argv
 
@@ -194,8 +329,8 @@ def main():
     app.config['IS_DESKTOP_APP'] = True
     api = Api()
 
-    # 起動時に以前のタスク履歴を読み込む
-    load_tasks_on_startup()
+    # 起動時に以前のタスク履歴を読み込む (ウィンドウの起動と並行して別スレッドで行う)
+    load_tasks_in_background(load_tasks_on_startup)
 
     # ウィンドウのサイズとリサイズの可否を設定します
     window = webview.create_window(
@@ -210,6 +345,7 @@ def main():
     # ウィンドウが閉じられる際のイベントにハンドラを接続
     window.events.closing += on_closing
     # ウィンドウが完全に閉じられた後のイベントにハンドラを接続
+    window.events.closed += api.flush_config
     window.events.closed += save_tasks_on_close
 
     # http_server=True は create_window ではなく start に渡します
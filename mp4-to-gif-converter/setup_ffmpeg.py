@@ -1,8 +1,38 @@
 import os
 import sys
+import io
 import shutil
 import urllib.request
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    # requests is optional; it adds connection reuse and automatic retries.
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+except ImportError:
+    requests = None
+
+def download(url, chunk_size):
+    """
+    Downloads the file at url into memory and returns it as a BytesIO.
+    With requests available, failed connections are retried on the same session
+    instead of restarting the whole setup.
+    """
+    if requests is None:
+        with urllib.request.urlopen(url) as response:
+            return io.BytesIO(response.read())
+
+    archive = io.BytesIO()
+    with requests.Session() as session:
+        session.mount("https://", HTTPAdapter(max_retries=Retry(total=3, backoff_factor=1.5)))
+        # The zip is already compressed; ask the server not to compress it again.
+        with session.get(url, stream=True, headers={"Accept-Encoding": "identity"}, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                archive.write(chunk)
+    archive.seek(0)
+    return archive
 
 def main():
     """
@@ -17,7 +47,8 @@ def main():
     TARGET_DIR = os.path.join("desktop_app", "bin")
     FFMPEG_EXE_PATH = os.path.join(TARGET_DIR, "ffmpeg.exe")
     FFPROBE_EXE_PATH = os.path.join(TARGET_DIR, "ffprobe.exe")
-    DOWNLOAD_ZIP_PATH = "ffmpeg-download.zip"
+    # Copy in 1 MiB chunks instead of the 16 KiB default to cut read/write syscalls
+    COPY_BUFFER_SIZE = 1024 * 1024
 
     # --- Check if FFmpeg already exists ---
     if os.path.exists(FFMPEG_EXE_PATH) and os.path.exists(FFPROBE_EXE_PATH):
@@ -25,10 +56,11 @@ def main():
         return
 
     # --- Download ---
+    # The archive is kept in memory instead of a temporary zip file,
+    # so it is not written to disk and read back before extraction.
     print(f"Downloading FFmpeg from {FFMPEG_URL}...")
     try:
-        with urllib.request.urlopen(FFMPEG_URL) as response, open(DOWNLOAD_ZIP_PATH, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
+        archive = download(FFMPEG_URL, COPY_BUFFER_SIZE)
     except Exception as e:
         print(f"Error: Failed to download FFmpeg. {e}", file=sys.stderr)
         sys.exit(1)
@@ -36,21 +68,28 @@ def main():
     # --- Extract ---
     print("Extracting FFmpeg binaries...")
     os.makedirs(TARGET_DIR, exist_ok=True)
-    try:
-        with zipfile.ZipFile(DOWNLOAD_ZIP_PATH) as z:
-            # Extract only ffmpeg.exe and ffprobe.exe from the archive's 'bin' folder
-            for filename in ["ffmpeg.exe", "ffprobe.exe"]:
-                # The files are inside a directory like 'ffmpeg-7.0-essentials_build/bin/'
-                # We find the full path inside the zip and extract it.
-                source_path = next((f.filename for f in z.infolist() if f.filename.endswith(f"bin/{filename}")), None)
-                if source_path:
-                    with z.open(source_path) as source, open(os.path.join(TARGET_DIR, filename), "wb") as target:
-                        shutil.copyfileobj(source, target)
-        print(f"Successfully placed ffmpeg.exe and ffprobe.exe in '{TARGET_DIR}'.")
-    finally:
-        # --- Cleanup ---
-        os.remove(DOWNLOAD_ZIP_PATH)
+    with zipfile.ZipFile(archive) as z:
+        # Extract only ffmpeg.exe and ffprobe.exe from the archive's 'bin' folder.
+        # The files are inside a directory like 'ffmpeg-7.0-essentials_build/bin/',
+        # so resolve both full paths inside the zip before starting any extraction.
+        targets = []
+        for filename in ["ffmpeg.exe", "ffprobe.exe"]:
+            source_path = next((f.filename for f in z.infolist() if f.filename.endswith(f"bin/{filename}")), None)
+            if source_path is None:
+                print(f"Error: {filename} was not found in the downloaded archive.", file=sys.stderr)
+                sys.exit(1)
+            targets.append((filename, source_path))
+
+        def _extract_one(name, src):
+            with z.open(src) as source, open(os.path.join(TARGET_DIR, name), "wb", buffering=COPY_BUFFER_SIZE) as target:
+                shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+        # Decompress both members in parallel (zlib releases the GIL while inflating).
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(_extract_one, name, src) for name, src in targets]
+            for future in as_completed(futures):
+                future.result()
+    print(f"Successfully placed ffmpeg.exe and ffprobe.exe in '{TARGET_DIR}'.")
 
 if __name__ == "__main__":
     main()
-
@@ -1,20 +1,67 @@
 import os
+import re
 import uuid
+import hashlib
+from urllib.parse import unquote
 import shutil
 import sys
 import json
 import threading
 import time
-from flask import Flask, request, jsonify, url_for, render_template, send_file
+import queue
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, request, jsonify, url_for, render_template, send_from_directory, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import NotFound
+try:
+    import orjson  # 高速なJSONライブラリ (なければFlask標準のJSONプロバイダーを使います)
+except ImportError:
+    orjson = None
+try:
+    import redis  # タスク状態の保存先としてRedisを使う場合のみ必要 (環境変数 REDIS_URL)
+except ImportError:
+    redis = None
 
 # 独自ライブラリのインポート
 from core_converter import conversion
 
 # --- WARNING ---
-# This implementation uses the filesystem as a simple task store.
+# This implementation uses the filesystem as a simple task store
+# (or Redis, when REDIS_URL is set and the redis package is installed).
 # It's a workaround for platforms without free background workers.
 app = Flask(__name__)
 
+# --- ロギング設定 ---
+# print は呼び出しのたびに標準出力へ同期的に書き込むため、ログはloggingモジュールにまとめます
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+
+# ステータスのポーリングなど頻繁に呼ばれるエンドポイントのため、JSONの変換はorjsonで行います
+class ORJSONProvider(DefaultJSONProvider):
+    """jsonifyやrequest.get_jsonのJSON処理をorjsonで行うプロバイダー。"""
+    def dumps(self, obj, **kwargs):
+        # orjsonの出力は常に区切り文字の空白を含まないため、separatorsの指定は不要
+        kwargs.pop('separators', None)
+        if kwargs:
+            # indentなど標準jsonのオプションが指定された場合は既定の実装に任せる
+            return super().dumps(obj, **kwargs)
+        # 既定の実装と同じくキーを並べ替え、ETagなどが実装によって変わらないようにする
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+if orjson:
+    app.json = ORJSONProvider(app)
+
+# タスクID (およびGIFファイル名の拡張子を除いた部分) として許可する文字列。UUIDがこれに一致します。
+_TASK_RE = re.compile(r'\A[A-Za-z0-9_-]{1,64}\Z')
+
 # --- プロジェクトパス設定 ---
 # このファイル(app.py)の場所を基準にプロジェクトのルートディレクトリを特定
 # これにより、どこからスクリプトを実行してもパスが安定します
@@ -26,22 +73,36 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
 FFPROBE_PATH = os.environ.get("FFPROBE_PATH", "ffprobe")
 # --- FFmpegの存在確認 (推奨) ---
-# アプリケーション起動時にFFmpegが利用可能かチェックします。
-if shutil.which(FFMPEG_PATH) is None:
-    print("=" * 60)
-    print(f"!!! クリティカルエラー: FFmpegが見つかりません。")
-    print(f"    指定されたパス/コマンド: {FFMPEG_PATH}")
-    print("    FFmpegをインストールし、PATHを通すか、環境変数 FFMPEG_PATH を設定してください。")
-    print("=" * 60)
+# アプリケーション起動時にFFmpegが利用可能かチェックし、実行ファイルを絶対パスに解決しておきます。
+# PATHの検索は起動時の1回だけで済み、subprocessがfork+execの代わりにposix_spawnを使えるようになります。
+# PATHが確実に分かっているコンテナなどでは、環境変数 SKIP_FFMPEG_CHECK を設定するとチェックを省略できます。
+def _exit_with_banner(*lines):
+    """エラーバナーを1回の書き込みで標準エラー出力に表示し、アプリケーションを終了します。"""
+    rule = "=" * 60
+    banner = "\n".join([rule, *lines, rule]) + "\n"
+    sys.stderr.buffer.write(banner.encode('utf-8'))
+    sys.stderr.buffer.flush()
     sys.exit(1)  # 必須コンポーネントがないため、アプリケーションを終了します。
 
-if shutil.which(FFPROBE_PATH) is None:
-    print("=" * 60)
-    print(f"!!! クリティカルエラー: ffprobeが見つかりません。")
-    print(f"    指定されたパス/コマンド: {FFPROBE_PATH}")
-    print("    FFmpegをインストールすると通常は含まれています。PATHを確認してください。")
-    print("=" * 60)
-    sys.exit(1)  # 必須コンポーネントがないため、アプリケーションを終了します。
+if os.environ.get("SKIP_FFMPEG_CHECK"):
+    FFMPEG_BIN = FFMPEG_PATH
+    FFPROBE_BIN = FFPROBE_PATH
+else:
+    FFMPEG_BIN = shutil.which(FFMPEG_PATH)
+    if FFMPEG_BIN is None:
+        _exit_with_banner(
+            "!!! クリティカルエラー: FFmpegが見つかりません。",
+            f"    指定されたパス/コマンド: {FFMPEG_PATH}",
+            "    FFmpegをインストールし、PATHを通すか、環境変数 FFMPEG_PATH を設定してください。",
+        )
+
+    FFPROBE_BIN = shutil.which(FFPROBE_PATH)
+    if FFPROBE_BIN is None:
+        _exit_with_banner(
+            "!!! クリティカルエラー: ffprobeが見つかりません。",
+            f"    指定されたパス/コマンド: {FFPROBE_PATH}",
+            "    FFmpegをインストールすると通常は含まれています。PATHを確認してください。",
+        )
 
 # --- ファイル保存ディレクトリ設定 ---
 # 無料プランでは永続ディスクが利用できないため、コンテナ内の一時的な
@@ -60,67 +121,224 @@ app.config['CLEANUP_DELAY_SECONDS'] = int(os.environ.get('CLEANUP_DELAY_SECONDS'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# ダウンロードしたGIFをブラウザやCDNにキャッシュさせる最大秒数
+DOWNLOAD_MAX_AGE_SECONDS = 3600
+
+def _download_max_age(path):
+    """
+    GIFをキャッシュさせる秒数を返します。
+    出力ファイルは作成から CLEANUP_DELAY_SECONDS 秒後に削除されるため、削除後にキャッシュの
+    再検証や再取得で404にならないよう、ファイルが残っている残り時間を超えないようにします。
+    """
+    try:
+        expires_at = os.stat(path).st_mtime + app.config['CLEANUP_DELAY_SECONDS']
+    except OSError:
+        return 0
+    return max(0, min(DOWNLOAD_MAX_AGE_SECONDS, int(expires_at - time.time())))
+
+# リクエストごとに app.config を引いて os.path.join しないよう、絶対パスを定数として保持しておきます
+UPLOAD_DIR = os.path.abspath(UPLOAD_FOLDER)
+OUTPUT_DIR = os.path.abspath(OUTPUT_FOLDER)
+
+class UploadRequest(Request):
+    """
+    アップロードされたファイルを、メモリや /tmp の一時ファイルを経由せず
+    UPLOAD_DIR 内のファイルに直接書き込むリクエストクラス。
+    保存時はコピーせずに名前を変更するだけで済みます。
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        path = f"{UPLOAD_DIR}{os.sep}{uuid.uuid4()}.mp4.part"
+        if not hasattr(self, '_part_paths'):
+            self._part_paths = []
+        self._part_paths.append(path)
+        return open(path, 'wb+')
+
+    def close(self):
+        # 名前を変更されずに残った書き込み途中のファイル (検証エラー時など) を削除します
+        super().close()
+        for path in getattr(self, '_part_paths', ()):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+app.request_class = UploadRequest
+
+# 本文をそのまま送るアップロード (application/octet-stream) を書き込む際の読み取り単位 (1MiB)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# アップロードサイズの上限 (MB)。環境変数 MAX_UPLOAD_MB が設定されている場合のみ制限します。
+if os.environ.get('MAX_UPLOAD_MB'):
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ['MAX_UPLOAD_MB']) * 1024 * 1024
+
+# --- 同時変換数の設定 ---
+# FFmpegは1プロセスで全コアを使おうとするため、同時に動かすプロセス数と
+# プロセスあたりのスレッド数を制限してCPUの奪い合いを防ぎます。
+MAX_CONCURRENT_CONVERSIONS = int(os.environ.get("MAX_CONCURRENT_CONVERSIONS", max(1, (os.cpu_count() or 1) // 4)))
+FFMPEG_THREADS_PER_JOB = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_CONVERSIONS)
+# 変換中の進捗を状態ファイルに書き込む最小間隔 (秒)
+PROGRESS_WRITE_INTERVAL_SECONDS = 0.5
+
+# --- 変換ワーカーのスレッドプール ---
+# アップロードごとにスレッドを作らず、決まった数のワーカーで順番に処理します。
+# ワーカー1つが同時に動かすFFmpegは1プロセスだけなので、プールのサイズがそのまま同時変換数の上限になります。
+# 受け付け済み (実行中 + 待機中) のタスクが上限に達したら、新しいアップロードは 503 で断ります。
+MAX_QUEUED_CONVERSIONS = int(os.environ.get("MAX_QUEUED_CONVERSIONS", MAX_CONCURRENT_CONVERSIONS * 4))
+CONVERSION_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CONVERSIONS, thread_name_prefix="conv")
+CONVERSION_SLOTS = threading.BoundedSemaphore(MAX_QUEUED_CONVERSIONS)
+# 1件の変換が使えるCPU時間の上限 (秒)。暴走したFFmpegがワーカーを占有し続けないよう打ち切ります (0で無制限)
+CONVERSION_TIME_LIMIT_SECONDS = int(os.environ.get("CONVERSION_TIME_LIMIT_SECONDS", 0))
+
+# --- 削除予定ファイルのキュー ---
+# (削除予定時刻, パス) を期限の早い順に取り出し、クリーンアップスケジューラが期限ちょうどに削除します。
+# 定期的にフォルダ全体を走査する必要がなくなります。
+CLEANUP_QUEUE = queue.PriorityQueue()
+# 待機中のスケジューラに、より早い期限のファイルが追加されたことを知らせるイベント
+CLEANUP_WAKEUP = threading.Event()
+
+def schedule_cleanup(path, delay=None):
+    """ファイルを delay 秒後 (省略時は CLEANUP_DELAY_SECONDS 秒後) に削除するよう予約する。"""
+    if path:
+        if delay is None:
+            delay = app.config['CLEANUP_DELAY_SECONDS']
+        CLEANUP_QUEUE.put((time.time() + delay, path))
+        CLEANUP_WAKEUP.set()
+
+# --- タスク状態の保存先 ---
+# 環境変数 REDIS_URL が設定されていれば、状態ファイルの代わりにRedisへ保存します。
+# 進捗の更新やポーリングのたびにファイルを開閉せずに済み、有効期限はTTLで管理されます。
+# クライアントはプロセスで1つだけ作り、全てのワーカーとリクエストで接続プールを共有します。
+# プールの接続数には上限を設け、上限に達した場合はエラーにせず空きを待ちます。
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 32))
+redis_client = None
+if REDIS_URL:
+    if redis is None:
+        logger.warning("REDIS_URL が設定されていますが、redisパッケージがないため状態ファイルを使用します。")
+    else:
+        _redis_pool = redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS)
+        redis_client = redis.Redis(connection_pool=_redis_pool)
+
+# --- 状態変化の通知 (Server-Sent Events用) ---
+# 同じプロセス内で変換中のタスクは、状態ファイルを更新したタイミングでSSEストリームを起こします。
+# 別プロセス (Gunicornの別ワーカーなど) で処理中のタスクは、一定間隔で状態ファイルを確認します。
+task_events = {}
+# 同じプロセス内で変換中のタスクの最新の状態 (JSONのバイト列)。SSEストリームはファイルを読まずにここから送信します。
+task_latest_status = {}
+SSE_RECHECK_SECONDS = 1.0
+SSE_KEEPALIVE_SECONDS = 15
+# SSEの接続は変換が終わるまでサーバーのスレッドを1つ占有します。
+# 同時に開ける数を制限し、上限を超えた接続は 503 で断ってポーリングに切り替えてもらいます。
+MAX_SSE_STREAMS = int(os.environ.get("MAX_SSE_STREAMS", 4))
+SSE_STREAM_SLOTS = threading.BoundedSemaphore(MAX_SSE_STREAMS)
+
+# テンプレートは実行時に変化しないため、起動時に一度だけレンダリングしておきます
+with app.app_context():
+    _INDEX_HTML = render_template('index.html').encode('utf-8')
+    _LICENSES_HTML = render_template('licenses.html').encode('utf-8')
+
 @app.route('/')
 def index():
-    """HTMLページをレンダリングして表示します。"""
-    return render_template('index.html')
+    """HTMLページを表示します。(起動時にレンダリング済み)"""
+    return Response(_INDEX_HTML, mimetype='text/html')
 
 @app.route('/licenses')
 def licenses():
-    """ライセンス情報を表示するページ。"""
-    return render_template('licenses.html')
+    """ライセンス情報を表示するページ。(起動時にレンダリング済み)"""
+    return Response(_LICENSES_HTML, mimetype='text/html')
+
+def _dump_status(status_data, indent=False):
+    """タスクの状態をUTF-8のJSONバイト列に変換します。orjsonがあればそちらを使います。"""
+    if orjson:
+        return orjson.dumps(status_data, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(status_data, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
 
 def update_task_status(task_id, state, data=None):
-    """タスクの状態をJSONファイルに書き込む。"""
+    """タスクの状態をJSONファイル (またはRedis) に書き込む。"""
     # パス構築と検証をヘルパー関数に一元化する
     status_filepath = get_status_filepath(task_id)
     if not status_filepath:
-        print(f"!!! エラー: 無効なtask_id '{task_id}' のため、ステータスを更新できません。")
+        logger.error("無効なtask_id '%s' のため、ステータスを更新できません。", task_id)
         return
 
     status_data = {'state': state}
     if data:
         status_data.update(data)
-    with open(status_filepath, 'w', encoding='utf-8') as f:
-        json.dump(status_data, f, ensure_ascii=False, indent=2)
+    raw = _dump_status(status_data)
+    if redis_client is not None:
+        redis_client.set(f"task:{task_id}", raw, ex=app.config['CLEANUP_DELAY_SECONDS'])
+    else:
+        # 一時ファイルに書いてから置き換えることで、読み取り側が書き込み途中のファイルを見ないようにします
+        temp_filepath = f"{status_filepath}.tmp"
+        with open(temp_filepath, 'wb') as f:
+            f.write(_dump_status(status_data, indent=True))
+        os.replace(temp_filepath, status_filepath)
+
+    event = task_events.get(task_id)
+    if event:
+        task_latest_status[task_id] = raw
+        event.set()
+
+def read_task_status(task_id):
+    """保存されているタスクの状態 (JSONのバイト列) を返します。見つからなければNoneを返します。"""
+    status_filepath = get_status_filepath(task_id)
+    if not status_filepath:
+        return None
+    if redis_client is not None:
+        return redis_client.get(f"task:{task_id}")
+    try:
+        with open(status_filepath, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
 
 def _cleanup_task_files(task_id, paths_to_delete):
     """指定されたタスクに関連するファイル群を安全に削除する。"""
-    print(f"タスク {task_id} のクリーンアップを開始します...")
+    logger.info("タスク %s のクリーンアップを開始します...", task_id)
     for path in paths_to_delete:
         try:
             if path and os.path.exists(path):
                 os.remove(path)
-                print(f"ファイルを削除しました: {path}")
+                logger.info("ファイルを削除しました: %s", path)
         except OSError as e:
-            print(f"ファイル削除中にエラーが発生しました {path}: {e}")
+            logger.warning("ファイル削除中にエラーが発生しました %s: %s", path, e)
 
 def conversion_worker(task_id, input_path, output_path, start_time, end_time, fps, width, high_quality):
     """バックグラウンドで変換処理を実行し、状態をファイルに記録する関数。"""
     try:
-        # 1. 動画の長さを取得
-        update_task_status(task_id, 'PROGRESS', {'progress': 0, 'step': '動画情報の取得中...'})
-        video_duration = conversion.get_video_duration(FFPROBE_PATH, input_path)
-        if video_duration is None:
-            raise Exception("動画の情報を取得できませんでした。")
-
-        # 2. 実際に変換する区間の長さを計算
+        # 1. 実際に変換する区間の長さを計算
         if end_time is not None:
-            actual_end_time = min(end_time, video_duration)
-            conversion_duration = actual_end_time - start_time
+            # 終了時間が指定されていれば区間の長さは分かっているため、ffprobeの起動を省きます
+            # (終了時間が動画より長い場合も、FFmpegは動画の最後で変換を終えます)
+            conversion_duration = end_time - start_time
         else:
+            # 2. 動画の最後まで変換する場合だけ、動画の長さを取得
+            update_task_status(task_id, 'PROGRESS', {'progress': 0, 'step': '動画情報の取得中...'})
+            video_duration = conversion.get_video_duration(FFPROBE_BIN, input_path)
+            if video_duration is None:
+                raise Exception("動画の情報を取得できませんでした。")
             conversion_duration = video_duration - start_time
 
         if conversion_duration <= 0:
             raise ValueError("変換区間が0秒以下です。開始時間と終了時間を確認してください。")
 
         # 3. 進捗をファイルに書き込むためのコールバック関数を定義
+        # 書き込みは進捗率が変わったとき、かつ前回から一定時間以上経ったときだけに間引きます (100%は必ず反映)
+        last_update = {'progress': -1, 'time': 0.0}
         def progress_callback(progress, step):
+            now = time.monotonic()
+            if progress == last_update['progress']:
+                return
+            if progress < 100 and now - last_update['time'] < PROGRESS_WRITE_INTERVAL_SECONDS:
+                return
             update_task_status(task_id, 'PROGRESS', {'progress': progress, 'step': step})
+            last_update.update(progress=progress, time=now)
 
-        # 4. コア変換処理を呼び出す
+        # 4. コア変換処理を呼び出す (同時実行数はスレッドプールのサイズで制限)
+        # 出力ファイルの事前確保 (posix_fallocate) は行いません。FFmpegは `-y` で出力を
+        # O_TRUNC付きで開き直すため、確保した領域は書き込み前に捨てられるためです。
         conversion.run_conversion(
-            ffmpeg_path=FFMPEG_PATH,
+            ffmpeg_path=FFMPEG_BIN,
             input_path=input_path,
             output_path=output_path,
             start_time=start_time,
@@ -129,7 +347,10 @@ def conversion_worker(task_id, input_path, output_path, start_time, end_time, fp
             width=width,
             conversion_duration=conversion_duration,
             high_quality=high_quality,
-            progress_callback=progress_callback
+            progress_callback=progress_callback,
+            threads=FFMPEG_THREADS_PER_JOB,
+            time_limit=CONVERSION_TIME_LIMIT_SECONDS,
+            fast_seek=True  # 入力側でシークする (再エンコードするため、-accurate_seek によりフレーム単位で正確)
         )
 
         # 5. 変換結果の検証
@@ -142,35 +363,44 @@ def conversion_worker(task_id, input_path, output_path, start_time, end_time, fp
         filename = os.path.basename(output_path)
         update_task_status(task_id, 'SUCCESS', {'result': {'output_path': output_path, 'filename': filename}})
 
+    except conversion.FFmpegError as e:
+        # FFmpegの出力にはサーバーのパスやビルド設定が含まれるため、ログにだけ記録し、
+        # クライアントには短いメッセージを返します
+        logger.error("Task %s failed: %s\n%s", task_id, e, e.stderr_tail)
+        update_task_status(task_id, 'FAILURE', {'error': "GIFへの変換に失敗しました。動画ファイルや変換の設定を確認してください。"})
     except Exception as e:
-        print(f"Task {task_id} failed: {e}")
+        logger.error("Task %s failed: %s", task_id, e)
         update_task_status(task_id, 'FAILURE', {'error': str(e)})
     finally:
-        # 変換ワーカーの責務は変換処理のみに限定します。
-        # 一時的な入力ファイルは不要になったため、ここで削除します。
-        # 出力ファイルとステータスファイルは、後述の定期クリーンアップ処理に任せます。
-        try:
-            if input_path and os.path.exists(input_path):
-                os.remove(input_path)
-        except OSError as e:
-            print(f"一時入力ファイルの削除に失敗しました {input_path}: {e}")
+        task_events.pop(task_id, None)
+        task_latest_status.pop(task_id, None)
+        # 出力ファイルとステータスファイルは、一定時間後にクリーンアップスケジューラが削除します。
+        schedule_cleanup(output_path)
+        schedule_cleanup(get_status_filepath(task_id))
+        # 一時的な入力ファイルは不要になったため、すぐに削除するよう予約します。
+        # 削除はクリーンアップスケジューラが行うので、ワーカーはファイル操作を待たずに次のタスクへ移れます。
+        schedule_cleanup(input_path, delay=0)
 
 def get_status_filepath(task_id):
     """ステータスファイルのパスを返すヘルパー関数。"""
     # ファイル名にディレクトリトラバーサルのような危険な文字が含まれていないことを確認
-    if not all(c.isalnum() or c in '-_' for c in task_id):
+    if not _TASK_RE.match(task_id):
         return None
-    return os.path.join(app.config['OUTPUT_FOLDER'], f"{task_id}.status.json")
+    return f"{OUTPUT_DIR}{os.sep}{task_id}.status.json"
     
 def _parse_conversion_params():
-    """フォームから変換パラメータを解析し、辞書またはエラーレスポンスを返す。"""
+    """
+    フォーム (またはクエリ文字列) から変換パラメータを解析し、辞書またはエラーレスポンスを返す。
+    本文にファイルだけを送るアップロードでは、パラメータはクエリ文字列で受け取ります。
+    """
+    values = request.values
     try:
         params = {
-            'start_time': request.form.get('start_time', 0, type=float),
-            'end_time': request.form.get('end_time', default=None, type=float),
-            'fps': request.form.get('fps', 10, type=int),
-            'width': request.form.get('width', 320, type=int),
-            'high_quality': request.form.get('high_quality') == 'true'
+            'start_time': values.get('start_time', 0, type=float),
+            'end_time': values.get('end_time', default=None, type=float),
+            'fps': values.get('fps', 10, type=int),
+            'width': values.get('width', 320, type=int),
+            'high_quality': values.get('high_quality') == 'true'
         }
         return params, None
     except (ValueError, TypeError):
@@ -178,69 +408,110 @@ def _parse_conversion_params():
 
 @app.route('/convert', methods=['POST'])
 def start_conversion_task():
-    """MP4ファイルを受け取り、非同期の変換タスクを開始します。"""
+    """
+    MP4ファイルを受け取り、非同期の変換タスクを開始します。
+    multipart/form-data のほか、本文に動画そのものを送る application/octet-stream も受け付けます
+    (ファイル名は X-Filename ヘッダーで、パラメータはクエリ文字列で指定)。
+    """
     # 1. リクエストのバリデーション
-    file = request.files.get('file')
+    # 本文を読み始める前にファイル名を確認し、不正なアップロードは受信せずに拒否します
+    is_raw_upload = request.mimetype == 'application/octet-stream'
+    if is_raw_upload:
+        file = None
+        filename = unquote(request.headers.get('X-Filename', ''))
+    else:
+        file = request.files.get('file')
+        filename = file.filename if file else ''
 
     # ファイルが存在しない、またはファイル名が空の場合はエラー
-    if not file or file.filename == '':
+    if not filename:
         return jsonify({"error": "ファイルが選択されていません"}), 400
 
-    if not file.filename.lower().endswith('.mp4'):
+    if not filename.lower().endswith('.mp4'):
         return jsonify({"error": "MP4形式のファイルのみアップロードできます。"}), 400
     # 2. パラメータの取得とデフォルト値の設定
     params, error_response = _parse_conversion_params()
     if error_response:
         return error_response
 
+    # 先頭12バイトを読み、MP4のシグネチャ (4〜8バイト目の 'ftyp') がなければ
+    # 残りを受信したりワーカーを起動したりせずに拒否します
+    stream = request.stream if is_raw_upload else file.stream
+    head = stream.read(12)
+    if head[4:8] != b'ftyp':
+        return jsonify({"error": "MP4形式のファイルではありません。"}), 415
+    if not is_raw_upload:
+        file.stream.seek(0)
+
+    # 混雑時はここで断ります (本文をそのまま送るアップロードは、残りの本文を受信せずに済みます。
+    # multipart/form-data の場合は、フォームの解析時に既に受信し終えています)
+    if not CONVERSION_SLOTS.acquire(blocking=False):
+        return jsonify({"error": "現在混み合っています。しばらくしてから再度お試しください。"}), 503
+
     # 3. 一時ファイルの準備
     # 安全なファイル名を生成するためにUUIDを使用
     unique_id = str(uuid.uuid4())
     input_filename = f"{unique_id}.mp4"
     output_filename = f"{unique_id}.gif"
-    input_path = os.path.join(app.config['UPLOAD_FOLDER'], input_filename)
-    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-
-    # 4. アップロードされたファイルをサーバーに保存
-    file.save(input_path)
-
-    # 5. タスクの初期状態をファイルに書き込み、別スレッドで処理を開始
+    input_path = f"{UPLOAD_DIR}{os.sep}{input_filename}"
+    output_path = f"{OUTPUT_DIR}{os.sep}{output_filename}"
     task_id = unique_id
-    update_task_status(task_id, 'PENDING')
-    
-    # スレッドに渡す引数を一つのタプルにまとめることで、
-    # 引数の渡し間違いを防ぎ、コードの可読性を向上させます。
-    thread_args = (
-        task_id,
-        input_path,
-        output_path,
-        params['start_time'],
-        params['end_time'],
-        params['fps'],
-        params['width'],
-        params['high_quality']
-    )
-    thread = threading.Thread(
-        target=conversion_worker,
-        args=thread_args
-    )
-    thread.start()
+
+    # 受け付け枠を確保してからワーカーに渡すまでの間に失敗した場合 (ディスクの空き不足やRedisの停止など) は、
+    # 枠を返さないと受け付けられるタスクが減り続けるため、必ず返してから例外を送出します
+    try:
+        # 4. アップロードされたファイルをサーバーに保存
+        if is_raw_upload:
+            # 本文を一定サイズずつ読み取り、メモリに溜めずにそのまま書き込みます
+            with open(input_path, 'wb', buffering=0) as out:
+                out.write(head)
+                while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+                    out.write(chunk)
+        else:
+            # 受信時に UPLOAD_DIR 内へ直接書き込まれているため、名前を変更するだけで済みます
+            file.stream.close()
+            os.replace(file.stream.name, input_path)
+
+        # ワーカーが削除し損ねた場合に備え、入力ファイルの削除も予約しておきます
+        schedule_cleanup(input_path)
+
+        # 5. タスクの初期状態をファイルに書き込み、スレッドプールで処理を開始
+        task_events[task_id] = threading.Event()
+        update_task_status(task_id, 'PENDING')
+
+        # ワーカーに渡す引数を一つのタプルにまとめることで、
+        # 引数の渡し間違いを防ぎ、コードの可読性を向上させます。
+        thread_args = (
+            task_id,
+            input_path,
+            output_path,
+            params['start_time'],
+            params['end_time'],
+            params['fps'],
+            params['width'],
+            params['high_quality']
+        )
+        future = CONVERSION_EXECUTOR.submit(conversion_worker, *thread_args)
+    except Exception:
+        CONVERSION_SLOTS.release()
+        task_events.pop(task_id, None)
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        raise
+    # タスクが終わったら受け付け枠を空けます
+    future.add_done_callback(lambda _: CONVERSION_SLOTS.release())
 
     # 6. タスクIDとステータス確認用URLをクライアントに返す
     return jsonify({
         "task_id": task_id,
-        "status_url": url_for('get_task_status', task_id=task_id)
+        "status_url": url_for('get_task_status', task_id=task_id),
+        "events_url": url_for('task_events_stream', task_id=task_id)
     }), 202  # 202 Accepted: リクエストは受理されたが、処理は完了していない
 
-@app.route('/status/<task_id>')
-def get_task_status(task_id):
-    """タスクの現在の状態を返します。"""
-    status_filepath = get_status_filepath(task_id)
-    if not status_filepath or not os.path.exists(status_filepath):
-        return jsonify({'state': 'NOT_FOUND', 'error': 'タスクが見つかりません。'}), 404
-
-    with open(status_filepath, 'r', encoding='utf-8') as f:
-        status_data = json.load(f)
+def _build_status_data(raw):
+    """保存されている状態を解析し、クライアントに返す辞書を作成します。"""
+    # orjson.JSONDecodeError は json.JSONDecodeError のサブクラスなので、呼び出し側の例外処理は共通です
+    status_data = orjson.loads(raw) if orjson else json.loads(raw)
 
     # 成功した場合、ダウンロードURLを追加する
     if status_data.get('state') == 'SUCCESS':
@@ -248,57 +519,187 @@ def get_task_status(task_id):
         filename = status_data.get('result', {}).get('filename')
         if filename:
             status_data['download_url'] = url_for('download_gif', filename=filename)
+    return status_data
+
+@app.route('/status/<task_id>')
+def get_task_status(task_id):
+    """タスクの現在の状態を返します。"""
+    raw = read_task_status(task_id)
+    if raw is None:
+        return jsonify({'state': 'NOT_FOUND', 'error': 'タスクが見つかりません。'}), 404
 
-    return jsonify(status_data)
+    # ETagは保存されている状態そのもののハッシュから作ります。
+    # 進捗が変わっていないポーリングには、JSONの解析や生成をせずに 304 Not Modified で応答します
+    etag = hashlib.blake2b(raw, digest_size=8).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        status_data = _build_status_data(raw)
+    except json.JSONDecodeError:
+        # 読み取れない状態は一時的なものとして扱い、クライアントには次のポーリングを待ってもらいます
+        return jsonify({'state': 'PROGRESS', 'step': '状態を確認しています...'})
+
+    response = jsonify(status_data)
+    response.set_etag(etag)
+    if status_data.get('state') == 'PROGRESS':
+        response.cache_control.max_age = 1
+    return response
+
+@app.route('/status/<task_id>/stream')
+@app.route('/events/<task_id>')
+def task_events_stream(task_id):
+    """
+    タスクの状態をServer-Sent Eventsで配信します。
+    状態が更新されるたびに送信し、完了 (成功/失敗) したらストリームを閉じます。
+    同じプロセスで変換中のタスクはメモリ上の最新状態を送り、状態ファイルは読みません。
+    """
+    if read_task_status(task_id) is None:
+        return jsonify({'state': 'NOT_FOUND', 'error': 'タスクが見つかりません。'}), 404
+    if not SSE_STREAM_SLOTS.acquire(blocking=False):
+        return jsonify({'error': '同時接続数の上限に達しました。ポーリングで状態を確認してください。'}), 503
+
+    def generate():
+        last_raw = None
+        idle_seconds = 0.0
+        while True:
+            # 先にクリアしてから状態を読むことで、読み取り後の更新を取りこぼさない
+            event = task_events.get(task_id)
+            if event:
+                event.clear()
+            raw = task_latest_status.get(task_id) or read_task_status(task_id)
+            if raw is None:
+                # 定期クリーンアップ (またはTTL) で状態が削除された
+                return
+
+            if raw != last_raw:
+                try:
+                    status_data = _build_status_data(raw)
+                except json.JSONDecodeError:
+                    status_data = None  # 書き込み途中のファイルを読んだ場合は次の確認を待つ
+                if status_data is not None:
+                    last_raw = raw
+                    idle_seconds = 0.0
+                    yield f"data: {app.json.dumps(status_data)}\n\n"
+                    if status_data.get('state') in ('SUCCESS', 'FAILURE'):
+                        return
+            elif idle_seconds >= SSE_KEEPALIVE_SECONDS:
+                # 更新がなくてもコメント行を送り、接続を維持する
+                idle_seconds = 0.0
+                yield ": keep-alive\n\n"
+
+            if event:
+                event.wait(timeout=SSE_RECHECK_SECONDS)
+            else:
+                time.sleep(SSE_RECHECK_SECONDS)
+            idle_seconds += SSE_RECHECK_SECONDS
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache"
+    })
+    # 送信の完了時にも、クライアントの切断時にも呼ばれるため、ここで枠を返します
+    response.call_on_close(SSE_STREAM_SLOTS.release)
+    return response
 
 @app.route('/download/<filename>')
 def download_gif(filename):
     """生成されたGIFファイルを安全に送信する。"""
-    # ファイル名に危険な文字が含まれていないか基本的なチェック
-    # (UUIDを使っているので通常は安全ですが、念のため)
-    if '..' in filename or os.path.isabs(filename):
+    # ファイル名は "<タスクID>.gif" の形式のみ許可し、ディレクトリトラバーサルなどを防ぐ
+    stem, ext = os.path.splitext(filename)
+    if ext != '.gif' or not _TASK_RE.match(stem):
         return jsonify({"error": "不正なファイル名です。"}), 400
 
-    # send_file を使ってファイルを直接送信します。
-    # これにより、ファイルがバイナリモードで正しく扱われることが保証されます。
-    file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+    # send_from_directory を使ってファイルを直接送信します。
+    # WSGIサーバーが wsgi.file_wrapper (sendfile) を使えるため、Python側でのコピーが発生しません。
+    # conditional=True と ETag/Last-Modified により Range/If-None-Match/If-Modified-Since にも対応し、
+    # max_age を付けることで前段のCDNやブラウザのキャッシュからも再送できるようにします。
+    # ファイルの削除はダウンロード時には行わず、クリーンアップスケジューラに任せます
+    # (キャッシュの有効期限は、スケジューラが削除するまでの残り時間に収めます)。
     try:
-        return send_file(
-            file_path,
-            mimetype='image/gif'
+        return send_from_directory(
+            OUTPUT_DIR,
+            filename,
+            mimetype='image/gif',
+            conditional=True,
+            etag=True,
+            max_age=_download_max_age
         )
-    except FileNotFoundError:
+    except NotFound:
         return jsonify({"error": "ファイルが見つからないか、既に削除されています。"}), 404
 
+def _enqueue_existing_files():
+    """
+    起動時に一度だけ作業フォルダを走査し、前回の実行で残ったファイルを削除キューに登録する。
+    期限切れのファイルはすぐに削除され、それ以外は更新時刻から数えた期限に削除される。
+    """
+    delay = app.config['CLEANUP_DELAY_SECONDS']
+    for folder in [UPLOAD_DIR, OUTPUT_DIR]:
+        try:
+            # scandirならエントリごとの種別判定と更新時刻の取得を1回のstatで済ませられます
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        CLEANUP_QUEUE.put((entry.stat().st_mtime + delay, entry.path))
+        except Exception as e:
+            logger.warning("クリーンアップ対象の走査中にエラーが発生しました (フォルダ: %s): %s", folder, e)
+
 def cleanup_scheduler():
-    """定期的に古いファイルをクリーンアップするバックグラウンドタスク。"""
+    """削除予定のファイルを期限の早い順に待ち、期限が来たら削除するバックグラウンドタスク。"""
     delay = app.config['CLEANUP_DELAY_SECONDS']
-    check_interval = 600  # 10分ごとにチェック
-    print(f"クリーンアップスケジューラを起動します。{delay}秒より古いファイルを削除します。")
+    logger.info("クリーンアップスケジューラを起動します。%d秒より古いファイルを削除します。", delay)
+    _enqueue_existing_files()
     while True:
-        time.sleep(check_interval)
-        print("古いファイルのクリーンアップチェックを実行します...")
-        now = time.time()
-        for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER']]:
+        # 取り出す前にクリアしておき、待機中に追加された予約を取りこぼさないようにします
+        CLEANUP_WAKEUP.clear()
+        expiry, file_path = CLEANUP_QUEUE.get()
+        wait = expiry - time.time()
+        if wait > 0 and CLEANUP_WAKEUP.wait(wait):
+            # 待機中に新しい予約 (すぐに削除する入力ファイルなど) が追加されたため、期限の早い順に選び直します
+            CLEANUP_QUEUE.put((expiry, file_path))
+            continue
+
+        # 期限を過ぎているファイルはまとめて取り出し、1回のログで報告します
+        expired_paths = [file_path]
+        while True:
+            try:
+                expiry, file_path = CLEANUP_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+            if expiry > time.time():
+                CLEANUP_QUEUE.put((expiry, file_path))
+                break
+            expired_paths.append(file_path)
+
+        deleted_count = 0
+        for file_path in expired_paths:
             try:
-                for filename in os.listdir(folder):
-                    file_path = os.path.join(folder, filename)
-                    if not os.path.isfile(file_path):
-                        continue
-                    
-                    file_mod_time = os.path.getmtime(file_path)
-                    if (now - file_mod_time) > delay:
-                        os.remove(file_path)
-                        print(f"古いファイルを削除しました: {file_path}")
-            except Exception as e:
-                print(f"クリーンアップ中にエラーが発生しました (フォルダ: {folder}): {e}")
+                os.remove(file_path)
+                deleted_count += 1
+            except FileNotFoundError:
+                pass  # ダウンロード後などに既に削除されている
+            except OSError as e:
+                logger.warning("クリーンアップ中にエラーが発生しました (%s): %s", file_path, e)
+        if deleted_count:
+            logger.info("古いファイルを%d件削除しました。", deleted_count)
+
+_cleanup_thread = None
+_cleanup_thread_lock = threading.Lock()
+
+def start_cleanup_scheduler():
+    """クリーンアップスケジューラをデーモンスレッドとして開始します (プロセスごとに1回だけ)。"""
+    global _cleanup_thread
+    with _cleanup_thread_lock:
+        if _cleanup_thread is None or not _cleanup_thread.is_alive():
+            _cleanup_thread = threading.Thread(target=cleanup_scheduler, name="cleanup", daemon=True)
+            _cleanup_thread.start()
+
+# Gunicornなど、このファイルを直接実行しない場合でも削除予約が処理されるよう、読み込み時に開始します。
+# デーモンスレッドのため、メインアプリケーションが終了すると、このスレッドも自動的に終了します。
+start_cleanup_scheduler()
 
 if __name__ == '__main__':
-    # デーモンスレッドとしてクリーンアップタスクを開始します。
-    # これにより、メインアプリケーションが終了すると、このスレッドも自動的に終了します。
-    cleanup_thread = threading.Thread(target=cleanup_scheduler, daemon=True)
-    cleanup_thread.start()
-
     # 開発用サーバーの起動 (本番環境ではGunicornなどを使用)
     # 環境変数からホストとポートを取得し、なければデフォルト値を使用する
     host = os.environ.get('FLASK_RUN_HOST', '127.0.0.1')